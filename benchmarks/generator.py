@@ -0,0 +1,187 @@
+"""Generator of the synthetic Carcade projects."""
+import os
+import math
+import random
+import datetime
+import codecs
+
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam '
+    'quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo '
+    'consequat duis aute irure in reprehenderit voluptate velit esse cillum '
+    'fugiat nulla pariatur excepteur sint occaecat cupidatat non proident '
+    'sunt culpa qui officia deserunt mollit anim id est laborum').split()
+
+LANGUAGE_CODES = ['en', 'ru', 'de', 'fr', 'es', 'it', 'pt', 'ja', 'zh', 'ko']
+
+LAYOUT = u'''<!DOCTYPE html>
+<html>
+<head>
+  <title>{{ title }}</title>
+  __ASSETS__
+</head>
+<body>
+  <a href="{{ url_for(ROOT.CHILDREN[0].PATH) }}">{{ _('Home') }}</a>
+  {% if PARENT and PARENT.PATH %}
+  <a href="{{ url_for(PARENT.PATH) }}">{{ PARENT.title }}</a>
+  {% endif %}
+  <h1>{{ title }}</h1>
+  {{ text }}
+  <ul>
+  {% for child in CHILDREN %}
+    <li><a href="{{ url_for(child.PATH) }}">{{ child.title }}</a></li>
+  {% endfor %}
+  </ul>
+  {% for sibling in SIBLINGS %}
+  <a href="{{ url_for(sibling.PATH) }}">{{ sibling.NAME }}</a>
+  {% endfor %}
+  <p>__FOOTER__</p>
+</body>
+</html>
+'''
+
+ASSETS = u'''{% assets 'bundle__INDEX__' %}
+  <link rel="stylesheet" href="{{ ASSET_URL }}">
+  {% endassets %}'''
+
+
+def get_languages(count):
+    """Returns `count` language codes."""
+    codes = LANGUAGE_CODES + [
+        'l%i' % i for i in range(len(LANGUAGE_CODES), count)]
+    return codes[:count]
+
+
+def generate_text(rand, size):
+    """Returns Markdown text of about `size` characters."""
+    paragraphs = []
+    length = 0
+    while length < size:
+        words = [rand.choice(WORDS) for _ in range(rand.randint(20, 60))]
+        words[rand.randrange(len(words))] = '*%s*' % rand.choice(WORDS)
+        paragraph = ' '.join(words).capitalize() + '.'
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return '\n\n'.join(paragraphs)
+
+
+def generate_page_paths(pages, depth):
+    """Returns list of `pages` page paths arranged in a tree that is
+    `depth` levels deep; every page (except the leaves) has the same number
+    of children.
+
+    >>> generate_page_paths(6, 2)
+    ['p0', 'p1', 'p2', 'p0/p0', 'p0/p1', 'p0/p2']
+    """
+    fanout = max(2, int(math.ceil(pages ** (1.0 / depth))))
+    paths = []
+    level = ['']
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                if len(paths) == pages:
+                    return paths
+                path = parent + 'p%i' % i
+                paths.append(path)
+                next_level.append(path + '/')
+        level = next_level
+    return paths
+
+
+def write(path, text):
+    dir_ = os.path.dirname(path)
+    if not os.path.exists(dir_):
+        os.makedirs(dir_)
+    with codecs.open(path, 'w', 'utf-8') as file_:
+        file_.write(text)
+
+
+def generate_settings(paths, language_codes, pagination, ordering, bundles):
+    """Returns source of the ``settings.py``."""
+    settings = [
+        'from webassets import Bundle',
+        'from carcade.utils import patterns',
+        '',
+        'DISK_CACHE = False',
+        "LAYOUTS = patterns((r'^.*$', 'page.html'))",
+    ]
+    if language_codes:
+        settings.append('LANGUAGES = %r' % language_codes)
+        settings.append('DEFAULT_LANGUAGE = %r' % language_codes[0])
+    if pagination:
+        # Generated pages only, not the intermediate ones
+        settings.append(
+            "PAGINATION = patterns((r'^(\\*|(.*/)?p\\d+)$', %i))" % pagination)
+
+    if ordering == 'alphabetically':
+        settings.append("ORDERING = patterns((r'^.*$', 'alphabetically'))")
+    elif ordering == 'explicit':
+        children = {}
+        for path in paths:
+            parent, _, name = path.rpartition('/')
+            children.setdefault(parent or '*', []).append(name)
+        settings.append('ORDERING = %r' % dict(
+            (parent, names[::-1]) for parent, names in children.iteritems()))
+    elif ordering == 'date':
+        settings[1] += ', order_by'
+        settings.append(
+            "ORDERING = patterns((r'^.*$', order_by('date', reverse=True)))")
+
+    settings.append('BUNDLES = {%s}' % ', '.join(
+        "'bundle%i': Bundle('css/%i.css', output='gen/%i.css')" % (i, i, i)
+        for i in range(bundles)))
+    return u'\n'.join(settings) + u'\n'
+
+
+def generate_site(project_dir, pages=1000, depth=3, pagination=0,
+                  ordering=None, languages=1, markdown_size=2000, bundles=0,
+                  seed=0):
+    """Generates the project with `pages` pages in `project_dir` and returns
+    list of their paths. The same arguments always produce the same project.
+
+    :param depth: depth of the pages tree
+    :param pagination: number of children per page (pagination is turned off
+                       if 0)
+    :param ordering: ``'alphabetically'``, ``'explicit'`` (every page lists
+                     the names of it's children in the reverse order),
+                     ``'date'`` (by the ``date`` field, newest first) or
+                     ``None``
+    :param languages: number of languages; every page has translated title
+                      and text in all the languages but the first one
+    :param markdown_size: approximate size of the page text in characters
+    :param bundles: number of webassets bundles included by the layout
+    """
+    rand = random.Random(seed)
+    language_codes = get_languages(languages) if languages > 1 else []
+    paths = generate_page_paths(pages, depth)
+
+    for index, path in enumerate(paths):
+        page_dir = os.path.join(project_dir, 'pages', path)
+        date = datetime.date(2000, 1, 1) + datetime.timedelta(days=index)
+        write(os.path.join(page_dir, 'data.yaml'),
+              u'title: Page %s\ndate: %s\ntags: [%s]\n' % (
+                  path, date, ', '.join(rand.sample(WORDS, 3))))
+        write(os.path.join(page_dir, 'text.md'),
+              generate_text(rand, markdown_size))
+        for language in language_codes[1:]:
+            write(os.path.join(page_dir, 'data.%s.yaml' % language),
+                  u'title: Page %s (%s)\n' % (path, language))
+            write(os.path.join(page_dir, 'text.%s.md' % language),
+                  generate_text(rand, markdown_size))
+
+    write(os.path.join(project_dir, 'settings.py'), generate_settings(
+        paths, language_codes, pagination, ordering, bundles))
+
+    for i in range(bundles):
+        write(os.path.join(project_dir, 'static', 'css', '%i.css' % i),
+              u'.class%i { color: #%06x; }\n' % (i, rand.randrange(0xffffff)))
+    write(os.path.join(project_dir, 'static', 'robots.txt'), u'')
+
+    assets = u''.join(ASSETS.replace('__INDEX__', str(i))
+                      for i in range(bundles))
+    layout = LAYOUT.replace('__ASSETS__', assets).replace(
+        '__FOOTER__', generate_text(rand, 200))
+    write(os.path.join(project_dir, 'layouts', 'page.html'), layout)
+    return paths
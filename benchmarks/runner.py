@@ -0,0 +1,237 @@
+"""Benchmark runner.
+
+Generates a synthetic project (see :func:`generator.generate_site`), times
+the core stages of the build on it and saves the results as JSON::
+
+    python -m benchmarks.runner run --pages 1000 --output before.json
+    python -m benchmarks.runner run --pages 1000 --output after.json
+    python -m benchmarks.runner compare before.json after.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+from functools import partial
+
+import argh
+
+from carcade import cache
+from carcade.conf import settings
+from carcade.inventory import create_inventory
+from carcade.utils import read_base_contexts
+from carcade.core import (
+    create_tree, sort_tree, paginate_tree, freeze_tree, index_tree, fill_tree,
+    url_for, create_environments, build_site, build)
+from benchmarks.generator import generate_site
+
+
+def repeat(function, runs, setup=None):
+    """Calls `function` `runs` times and returns list of the durations.
+    If `setup` is specified, it's called before each run and it's result is
+    passed to `function`; time spent in `setup` isn't counted.
+
+    In-memory caches are cleared before each run, so every run is cold.
+    """
+    timings = []
+    for _ in range(runs):
+        cache.clear()
+        args = (setup(),) if setup else ()
+        start_time = time.time()
+        function(*args)
+        timings.append(time.time() - start_time)
+    return timings
+
+
+def get_median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def get_git_commit():
+    """Returns hash of the current commit of the carcade repository
+    or ``None`` if it can't be determined.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_stages(project_dir, paths, runs):
+    """Times the stages of the build of the project at `project_dir`
+    that contains pages at `paths`. Returns dictionary that maps stage names
+    to the lists of durations.
+    """
+    pages_dir = os.path.join(project_dir, 'pages')
+    language = settings.LANGUAGES[0] if settings.LANGUAGES else None
+    get_inventory = lambda: create_inventory(
+        pages_dir, settings.LANGUAGES or (), threads=settings.SCAN_THREADS)
+    get_tree = lambda: create_tree(pages_dir, 'ROOT', inventory=get_inventory())
+    # Like :class:`core.Site`, sorting and filling share the parsed
+    # language-neutral data
+    base_contexts = read_base_contexts(get_inventory())
+    get_sorted_tree = lambda: sort_tree(
+        get_tree(), settings.ORDERING, base_contexts=base_contexts)
+    get_paginated_tree = lambda: paginate_tree(
+        get_sorted_tree(), settings.PAGINATION)
+    get_indexed_tree = lambda: index_tree(freeze_tree(get_paginated_tree()))
+
+    def get_filled_tree():
+        inventory = get_inventory()
+        tree = create_tree(pages_dir, 'ROOT', inventory=inventory)
+        tree = sort_tree(tree, settings.ORDERING, base_contexts=base_contexts)
+        tree = paginate_tree(tree, settings.PAGINATION)
+        tree = index_tree(freeze_tree(tree))
+        return fill_tree(tree, language=language, base_contexts=base_contexts,
+                         inventory=inventory)
+
+    def resolve_urls(tree):
+        for path in paths:
+            url_for(tree, path, language=language)
+
+    def prepare_build_site():
+        build_dir = tempfile.mkdtemp(dir=project_dir)
+        tree = get_filled_tree()
+        static_dir = os.path.join(build_dir, settings.STATIC_URL.lstrip('/'))
+        jinja2_env = create_environments(project_dir, static_dir, tree)
+        return jinja2_env, build_dir, tree
+
+    def prepare_build():
+        build_dir = os.path.join(project_dir, 'www')
+        if os.path.exists(build_dir):
+            shutil.rmtree(build_dir)
+        return build_dir
+
+    manifest_dir = os.path.join(project_dir, '.benchmark-manifests')
+    full_build = lambda build_dir: build(
+        project_dir, build_dir, manifest_dir=manifest_dir)
+
+    def prepare_incremental_build():
+        build_dir = os.path.join(project_dir, 'www')
+        if not os.path.exists(build_dir):
+            full_build(build_dir)
+        text_path = os.path.join(pages_dir, paths[-1], 'text.md')
+        with open(text_path, 'a') as file_:
+            file_.write('\n\nChanged at %r.\n' % time.time())
+        return build_dir
+
+    timings = {}
+    timings['create_inventory'] = repeat(get_inventory, runs)
+    timings['create_tree'] = repeat(get_tree, runs)
+    timings['read_base_contexts'] = repeat(
+        read_base_contexts, runs, setup=get_inventory)
+    timings['sort_tree'] = repeat(
+        partial(sort_tree, ordering_dict=settings.ORDERING,
+                base_contexts=base_contexts), runs, setup=get_tree)
+    timings['paginate_tree'] = repeat(
+        partial(paginate_tree, pagination_dict=settings.PAGINATION), runs,
+        setup=get_sorted_tree)
+    timings['fill_tree'] = repeat(
+        partial(fill_tree, language=language, base_contexts=base_contexts),
+        runs, setup=get_indexed_tree)
+    timings['url_for'] = repeat(resolve_urls, runs, setup=get_filled_tree)
+    timings['build_site'] = repeat(
+        lambda args: build_site(*args), runs, setup=prepare_build_site)
+    timings['build'] = repeat(full_build, runs, setup=prepare_build)
+    timings['incremental_build'] = repeat(
+        lambda build_dir: build(project_dir, build_dir,
+                                manifest_dir=manifest_dir, incremental=True),
+        runs, setup=prepare_incremental_build)
+    return timings
+
+
+@argh.arg('--ordering', choices=['alphabetically', 'explicit', 'date'])
+def run(pages=1000, depth=3, pagination=0, ordering=None, languages=1,
+        markdown_size=2000, bundles=0, seed=0, runs=5, output=None,
+        keep=False):
+    """Generates a synthetic project, times the build stages on it `runs`
+    times and prints the results as JSON (or saves them to `output`).
+
+    The project is generated in a temporary directory that is removed
+    afterwards unless `keep` is set.
+    """
+    config = {
+        'pages': pages,
+        'depth': depth,
+        'pagination': pagination,
+        'ordering': ordering,
+        'languages': languages,
+        'markdown_size': markdown_size,
+        'bundles': bundles,
+        'seed': seed,
+        'runs': runs,
+    }
+    project_dir = tempfile.mkdtemp(prefix='carcade-benchmark-')
+    current_dir = os.getcwd()
+    try:
+        paths = generate_site(
+            project_dir, pages=pages, depth=depth, pagination=pagination,
+            ordering=ordering, languages=languages,
+            markdown_size=markdown_size, bundles=bundles, seed=seed)
+        os.chdir(project_dir)
+        sys.path.insert(0, project_dir)
+        settings.configure('settings')
+        cache.configure(None)
+        timings = time_stages(project_dir, paths, runs)
+    finally:
+        os.chdir(current_dir)
+        if project_dir in sys.path:
+            sys.path.remove(project_dir)
+        if keep:
+            print >> sys.stderr, 'Project is kept in %s' % project_dir
+        else:
+            shutil.rmtree(project_dir)
+
+    results = {
+        'config': config,
+        'python': platform.python_version(),
+        'commit': get_git_commit(),
+        'stages': dict((name, {
+            'min': min(durations),
+            'median': get_median(durations),
+            'runs': durations,
+        }) for name, durations in timings.iteritems()),
+    }
+    if output:
+        with open(output, 'w') as file_:
+            json.dump(results, file_, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+
+def compare(old, new):
+    """Prints median timings of the stages from the `old` and `new` results
+    and their ratio.
+    """
+    with open(old) as file_:
+        old_results = json.load(file_)
+    with open(new) as file_:
+        new_results = json.load(file_)
+    if old_results['config'] != new_results['config']:
+        print 'Warning: results were obtained with different configurations.'
+
+    print '%-20s%10s%10s%8s' % ('stage', 'old', 'new', 'ratio')
+    old_stages, new_stages = old_results['stages'], new_results['stages']
+    for name in sorted(set(old_stages) & set(new_stages)):
+        old_median = old_stages[name]['median']
+        new_median = new_stages[name]['median']
+        ratio = new_median / old_median if old_median else float('inf')
+        print '%-20s%9.3fs%9.3fs%7.2fx' % (name, old_median, new_median, ratio)
+
+
+def main():
+    argh.dispatch_commands([run, compare])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import os
+import time
+import errno
+import cPickle as pickle
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """In-memory cache that holds up to `max_size` most recently used items."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            return default
+        self._items[key] = value
+        return value
+
+    def set(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+
+def touch(path):
+    """Marks the disk cache file at `path` as used (see :func:`prune`)."""
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+class DiskCache(object):
+    """Cache that pickles items to the files in `dir_` (one file per key).
+    Files are replaced atomically, so the cache can be shared between
+    processes. Files are touched when they're read, so the entries
+    that are no longer used can be pruned (see :func:`prune`).
+    """
+
+    def __init__(self, dir_):
+        self.dir_ = dir_
+
+    def _get_path(self, key):
+        return os.path.join(self.dir_, key[:2], key)
+
+    def get(self, key, default=None):
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as file_:
+                value = pickle.load(file_)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return default
+        touch(path)
+        return value
+
+    def set(self, key, value):
+        path = self._get_path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as file_:
+            pickle.dump(value, file_, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+
+class Cache(object):
+    """Two-tier cache: :class:`LRUCache` backed by optional :class:`DiskCache`.
+
+    Keys must be hex digests (see :func:`manifest.hash_strings`).
+    """
+
+    def __init__(self, name, max_size=4096):
+        self.name = name
+        self.memory = LRUCache(max_size)
+        self.disk = None
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is None and self.disk:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return default if value is None else value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk:
+            self.disk.set(key, value)
+
+
+_caches = {}
+_cache_dir = None
+
+
+def get_cache(name):
+    """Returns the process-wide :class:`Cache` called `name`."""
+    if name not in _caches:
+        cache = Cache(name)
+        if _cache_dir:
+            cache.disk = DiskCache(os.path.join(_cache_dir, name))
+        _caches[name] = cache
+    return _caches[name]
+
+
+def get_cache_dir(name):
+    """Returns directory for the disk cache called `name` (creating it
+    if needed) or ``None`` if disk caching is disabled.
+    """
+    if not _cache_dir:
+        return None
+    dir_ = os.path.join(_cache_dir, name)
+    try:
+        os.makedirs(dir_)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return dir_
+
+
+def configure(cache_dir=None):
+    """Enables disk tier of all the caches in `cache_dir`
+    or disables it if `cache_dir` is ``None``.
+    """
+    global _cache_dir
+    _cache_dir = cache_dir
+    for name, cache in _caches.iteritems():
+        cache.disk = cache_dir and DiskCache(os.path.join(cache_dir, name))
+
+
+def prune(max_age):
+    """Removes the files of the disk tier (including the directories
+    returned by :func:`get_cache_dir`) that haven't been written or read
+    for `max_age` seconds. Returns the number of removed files.
+    """
+    if not _cache_dir:
+        return 0
+    deadline = time.time() - max_age
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(_cache_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+                if max(stat.st_atime, stat.st_mtime) < deadline:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                # Removed by another process meanwhile
+                pass
+    return removed
+
+
+def clear():
+    """Clears in-memory tier of all the caches."""
+    for cache in _caches.itervalues():
+        cache.memory.clear()
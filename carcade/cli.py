@@ -1,19 +1,19 @@
 import os
 import sys
-import time
 import shutil
+import cProfile
 import traceback
 import os.path
 
 import argh
 
 import carcade
-from carcade import server
+from carcade import server, profiling
 from carcade.conf import settings
 from carcade.i18n import extract_translations
 from carcade.environments import create_jinja2_env
-from carcade.core import build as _build
-from carcade.utils import sh
+from carcade.core import (
+    build as _build, build_atomically, configure_cache, prune_cache)
 
 
 def init(project):
@@ -29,67 +29,105 @@ def init(project):
         print '%s successfully initialized.'
 
 
-def build(to='www', atomically=False):
-    """Builds the site."""
+def print_stats(stats):
+    """Prints the build statistics returned by :func:`core.build`."""
+    if 'static' in stats:
+        print ('Static files: %(linked)i linked, %(copied)i copied, '
+               '%(unchanged)i unchanged, %(removed)i removed.' % stats['static'])
+        print 'Bundles: %(bundles_rebuilt)i rebuilt, %(bundles_reused)i reused.' % stats
+
+
+def build(to='www', atomically=False, incremental=False, jobs=1,
+          profile=False, profile_output=None, slowest=10):
+    """Builds the site.
+
+    If `incremental` is set, renders only the pages whose sources, layouts
+    or templates have changed since the previous build to `to` and leaves
+    the rest of its content untouched. Builds made `atomically` are always
+    incremental relative to the previous atomic build.
+
+    Pages are rendered by `jobs` worker processes. Disk cache entries that
+    haven't been used for `DISK_CACHE_MAX_AGE` days are removed afterwards.
+
+    If `profile` is set, prints time spent in each stage of the build,
+    per layout, by the `slowest` pages and parsing the source files.
+    If `profile_output` is specified, cProfile statistics of the build
+    are saved there.
+    """
     settings.configure('settings')
 
+    if profile or profile_output:
+        profiling.enable()
+    if profile_output:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     print 'Build...'
     try:
         current_dir = os.getcwd()
+        manifest_dir = os.path.join(
+            current_dir, settings.CACHE_DIR, 'manifests',
+            os.path.basename(os.path.normpath(to)))
 
         if not atomically:
             build_dir = os.path.join(current_dir, to)
-            if os.path.exists(build_dir):
+            if os.path.exists(build_dir) and not incremental:
                 if os.path.islink(build_dir):
                     os.unlink(build_dir)
                 elif os.path.isdir(build_dir):
                     shutil.rmtree(build_dir)
 
-            _build(current_dir, build_dir)
+            stats = _build(
+                current_dir, build_dir, manifest_dir=manifest_dir,
+                incremental=incremental and os.path.exists(build_dir),
+                processes=jobs)
         else:
-            timestamp = int(time.time())
-            build_dir = os.path.join(current_dir, '.build-%s' % timestamp)
-
-            _build(current_dir, build_dir)
-
-            target_dir = os.path.join(current_dir, to)
-            previous_build_dir = None
-            if os.path.exists(target_dir):
-                if os.path.islink(target_dir):
-                    # If `target_dir` is the result of atomic build
-                    previous_build_dir = os.readlink(target_dir)
-                else:
-                    shutil.rmtree(target_dir)
-
-            # Link new build to ./www
-            # Is it really atomically? Consider using `mv -T`:
-            # http://rcrowley.org/2010/01/06/things-unix-can-do-atomically.html
-            sh('ln -snf %s %s' % (build_dir, target_dir))
-
-            # Remove old build if exists
-            if previous_build_dir:
-                shutil.rmtree(previous_build_dir)
+            stats = build_atomically(
+                current_dir, os.path.join(current_dir, to),
+                manifest_dir=manifest_dir, processes=jobs)
     except:
         print 'Ooops...'
         traceback.print_exc()
         return 1
     else:
+        print_stats(stats)
+        removed = prune_cache(current_dir)
+        if removed:
+            print 'Cache: %i unused entries removed.' % removed
+        if profiling.get_profile():
+            print profiling.get_profile().get_report(slowest=slowest)
         print 'Done.'
+    finally:
+        if profile_output:
+            profiler.disable()
+            profiler.dump_stats(profile_output)
+        profiling.disable()
 
 
-def runserver(host='localhost', port=8000):
+def runserver(host='localhost', port=8000, lazy=False, delay=0.5):
     """Fires up a server that will host `www` directory, monitor
     the changes and regenerate the site automatically.
+
+    If `lazy` is set, pages are rendered only when they're requested.
+    The site is rebuilt when no more changes occur for `delay` seconds.
     """
-    settings.configure('settings')
-    server.serve(host=host, port=port)
+    return server.serve(host=host, port=port, lazy=lazy, delay=delay)
 
 
-def extract_messages(to='translations/messages.pot'):
-    """Extracts localizable strings from the templates."""
+def extract_messages(to='translations/messages.pot', jobs=1):
+    """Extracts localizable strings from the templates.
+
+    Templates that have changed since the previous run are parsed
+    by `jobs` worker processes.
+    """
     settings.configure('settings')
+    configure_cache(os.getcwd())
     jinja2_env = create_jinja2_env()
-    extract_translations(jinja2_env, to)
+    if extract_translations(jinja2_env, to, processes=jobs,
+                            jinja2_env_factory=create_jinja2_env):
+        print '%s updated.' % to
+    else:
+        print '%s is up to date.' % to
 
 
 def main():
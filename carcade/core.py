@@ -1,15 +1,31 @@
 import os
+import sys
+import time
 import shutil
 import codecs
+import filecmp
 import os.path
+import subprocess
 import traceback
+import multiprocessing
 from functools import partial
 
+from carcade import cache, profiling
+from carcade.cache import get_cache_dir
 from carcade.conf import settings
 from carcade.i18n import get_translations
-from carcade.environments import create_jinja2_env, create_assets_env
-from carcade.utils import sort, paginate, read_context
-from carcade.exceptions import UnknownPathException, UnknownOrderingException
+from carcade.environments import (
+    create_jinja2_env, create_assets_env, configure_jinja2_env)
+from carcade.utils import (
+    sort, paginate, read_context, read_base_context, read_base_contexts,
+    ContextOrdering, LazyContext, load_context, record_reads)
+from carcade.inventory import scan_dir, create_inventory
+from carcade.manifest import (
+    Manifest, InputHasher, hash_strings, hash_file, get_bundle_digest,
+    get_bundles_digest, get_inventory_fingerprint)
+from carcade.exceptions import (
+    UnknownPathException, UnknownOrderingException, BuildException,
+    FrozenTreeException, BuildCancelledException)
 
 
 class Node(object):
@@ -30,19 +46,57 @@ class Node(object):
     .. attribute:: parent
 
        Parent node.
+
+    .. attribute:: context
+
+       Context dictionary (see :func:`fill_tree`).
+
+    .. attribute:: path_index
+
+       Dictionary that maps paths to the descendant nodes. Built for the root
+       node by :func:`index_tree`, ``None`` otherwise.
+
+    .. attribute:: frozen
+
+       Whether the tree is finalized (see :func:`freeze_tree`). Frozen node
+       can't get new children, but it's path, depth and slugs are computed
+       once instead of walking up to the root on every call.
     """
 
+    # There may be hundreds of thousands of nodes
+    __slots__ = ('name', 'children', 'source_dir', 'parent', 'context',
+                 'path_index', 'url_tables', 'frozen',
+                 '_path', '_depth', '_slugs')
+
     def __init__(self, source_dir, name):
         self.name = name
         self.children = []
         self.source_dir = source_dir
         self.parent = None
+        self.context = None
+        self.path_index = None
+        self.frozen = False
 
     def add_child(self, node):
         """Adds `node` to the child nodes."""
+        if self.frozen:
+            raise FrozenTreeException(self.get_path())
         self.children.append(node)
         node.parent = self
 
+    def freeze(self, path, depth, ancestor_slugs):
+        """Marks node as frozen and stores it's `path`, `depth` and slugs
+        (see :func:`freeze_tree`).
+
+        :param ancestor_slugs: intermediate slugs of the ancestors
+        """
+        self._path = path
+        self._depth = depth
+        self.frozen = True
+        self._slugs = ()
+        if self.parent:
+            self._slugs = ancestor_slugs + (self.get_slug(),)
+
     def get_child(self, name):
         """First tries to find and return immediate child called `name`.
         Then continues search by calling `get_child` on every immediate
@@ -64,6 +118,9 @@ class Node(object):
         """Returns descendant node identified by `path`.
         If nothing found, returns ``None``.
         """
+        if self.path_index is not None:
+            return self.path_index.get(path)
+
         if '/' in path:
             child_name, rest = path.split('/', 1)
             child = self.get_child(child_name)
@@ -84,6 +141,8 @@ class Node(object):
 
     def get_path(self):
         """Returns node path."""
+        if self.frozen:
+            return self._path
         names = []
         node = self
         while node.parent:
@@ -91,10 +150,23 @@ class Node(object):
             node = node.parent
         return '/'.join(reversed(names))
 
+    def get_depth(self):
+        """Returns number of the node ancestors."""
+        if self.frozen:
+            return self._depth
+        depth = 0
+        node = self
+        while node.parent:
+            depth += 1
+            node = node.parent
+        return depth
+
     def get_slugs(self):
         """Returns ancestor nodes slugs ordered from top (root)
         to bottom (this node).
         """
+        if self.frozen:
+            return self._slugs
         slugs = []
         intermediate = False
         node = self
@@ -102,7 +174,7 @@ class Node(object):
             slugs.append(node.get_slug(intermediate=intermediate))
             intermediate = True
             node = node.parent
-        return reversed(slugs)
+        return tuple(reversed(slugs))
 
 
 class PageNode(Node):
@@ -114,6 +186,8 @@ class PageNode(Node):
        1-based index.
     """
 
+    __slots__ = ('index',)
+
     def __init__(self, source_dir, index):
         self.index = index
         super(PageNode, self).__init__(source_dir, settings.PAGE_NAME % index)
@@ -128,28 +202,42 @@ class PageNode(Node):
         return super(PageNode, self).get_slug()
 
 
-def create_tree(page_dir, page_name):
-    """Creates tree that reflects the structure of `page_dir`."""
+def create_tree(page_dir, page_name, inventory=None):
+    """Creates tree that reflects the structure of `page_dir`.
+
+    Subdirectories are taken from the `inventory`
+    (see :func:`inventory.create_inventory`) if it's specified.
+    """
     node = Node(page_dir, page_name)
 
-    for subpage_name in os.listdir(page_dir):
+    if inventory is not None:
+        subpage_names = inventory[page_dir].subdirs
+    else:
+        subpage_names = scan_dir(page_dir).subdirs
+
+    for subpage_name in subpage_names:
         subpage_dir = os.path.join(page_dir, subpage_name)
-        if os.path.isdir(subpage_dir):
-            child = create_tree(subpage_dir, subpage_name)
-            node.add_child(child)
+        child = create_tree(subpage_dir, subpage_name, inventory=inventory)
+        node.add_child(child)
 
     return node
 
 
-def sort_tree(node, ordering_dict):
+def sort_tree(node, ordering_dict, base_contexts=None):
     """Recursively sorts the tree according to the `ordering_dict` --
     a dictionary where keys are node paths and values are the following:
 
     1. ``'alphabetically'``: children will be sorted by their names
     2. ``names list``: children will be sorted in the order in which their
        names appear in the list (see :func:`utils.sort`)
-    3. ``callable``: will be called with list of children and must
+    3. :class:`utils.ContextOrdering`: children will be sorted by the fields
+       of their language-neutral contexts (see :func:`utils.order_by`)
+    4. ``callable``: will be called with list of children and must
        return it sorted.
+
+    Contexts are taken from `base_contexts` (see
+    :func:`utils.read_base_contexts`) if it's specified, so that the files
+    parsed for sorting aren't parsed again by :func:`fill_tree`.
     """
     path = node.get_path()
     key = path or '*'
@@ -161,15 +249,34 @@ def sort_tree(node, ordering_dict):
         elif isinstance(ordering, list):
             node.children = sort(node.children, ordering,
                                  key=lambda child: child.name)
+        elif isinstance(ordering, ContextOrdering):
+            node.children = ordering.sort(
+                node.children,
+                get_context=partial(get_base_context, base_contexts))
         elif callable(ordering):
             node.children = ordering(node.children)
         else:
             raise UnknownOrderingException(key)
 
-    node.children = [sort_tree(child, ordering_dict) for child in node.children]
+    node.children = [sort_tree(child, ordering_dict,
+                               base_contexts=base_contexts)
+                     for child in node.children]
     return node
 
 
+def get_base_context(base_contexts, node):
+    """Returns language-neutral context of the `node` taken from
+    `base_contexts` or parsed if it's not there
+    (see :func:`utils.read_base_context`).
+    """
+    base_context = base_contexts and base_contexts.get(node.source_dir)
+    md_context, yaml_context = base_context or read_base_context(
+        node.source_dir)
+    context = LazyContext(md_context)
+    context.update(yaml_context)
+    return context
+
+
 def paginate_tree(node, pagination_dict):
     """Recursively paginates tree according to the `pagination_dict` --
     a dictionary where keys are node paths and values are the numbers of
@@ -199,7 +306,7 @@ def paginate_tree(node, pagination_dict):
     return node
 
 
-def fill_tree(node, language=None):
+def fill_tree(node, language=None, base_contexts=None, inventory=None):
     """Recursively walks the tree and annotates each node with context.
 
     Calls :func:`utils.read_context` and combines it's result with the
@@ -212,12 +319,23 @@ def fill_tree(node, language=None):
     * ``SIBLINGS``: list of the sibling contexts;
     * ``PARENT``: parent's context;
     * ``PREV_SIBLING``, ``NEXT_SIBLING``: adjacent siblings contexts.
+
+    If `base_contexts` (see :func:`utils.read_base_contexts`) is specified,
+    language-neutral data is taken from it instead of being parsed again.
+    Markdown files are parsed only when the templates read them
+    (see :class:`utils.LazyContext`).
+    Source files are looked up in the `inventory` if it's specified.
     """
-    context = read_context(node.source_dir, language=language)
+    base_context = base_contexts and base_contexts.get(node.source_dir)
+    info = inventory and inventory.get(node.source_dir)
+    context = read_context(
+        node.source_dir, language=language, base_context=base_context,
+        info=info)
 
     child_contexts = []
     for child in node.children:
-        fill_tree(child, language=language)
+        fill_tree(child, language=language, base_contexts=base_contexts,
+                  inventory=inventory)
         child_contexts.append(child.context)
 
     context.update({
@@ -247,43 +365,263 @@ def fill_tree(node, language=None):
     return node
 
 
-def build_site(jinja2_env, build_dir, node, root=None):
-    """Given the site tree, builds the site. The main steps are the following:
+def iter_tree(node):
+    """Yields the nodes of the tree bottom-up (children before parents)."""
+    for child in node.children:
+        for descendant in iter_tree(child):
+            yield descendant
+    yield node
+
+
+def get_layout(node):
+    """Returns the template name to render `node` with, based on
+    a `LAYOUTS` setting. Pages created by pagination use the layout of
+    the paginated node.
+    """
+    layout_key = node.get_path()
+    if isinstance(node, PageNode):
+        layout_key = node.parent.get_path()
+    return settings.LAYOUTS[layout_key]
+
+
+def render_page(jinja2_env, root, node, layout, target_filename):
+    """Renders `layout` in the `node` context to `target_filename`.
+    Returns the set of the source directories which contexts the page has
+    read (see :func:`utils.record_reads`).
+
+    The file is replaced atomically, so if it was hardlinked to the output
+    of the previous build, that one isn't modified.
+    """
+    target_dir = os.path.dirname(target_filename)
+    try:
+        os.makedirs(target_dir)
+    except OSError:
+        # Directory may be created concurrently by another worker
+        if not os.path.isdir(target_dir):
+            raise
+
+    template = jinja2_env.get_template(layout)
+    tmp_filename = '%s.%s.tmp' % (target_filename, os.getpid())
+    with record_reads() as dirs:
+        template.stream(ROOT=root.context, **load_context(node.context)).dump(
+            tmp_filename, encoding='utf-8')
+    os.rename(tmp_filename, target_filename)
+    return dirs
+
+
+def check_cancelled(cancel_event):
+    """Raises :class:`BuildCancelledException` if `cancel_event`
+    (:class:`threading.Event`) is set.
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise BuildCancelledException()
+
 
-    1. Build chidren subtrees;
-    2. Determine `index.html` directory (which is basically
+# State of the rendering worker process (see :func:`render_pages`)
+_worker_state = {}
+
+
+def _init_worker(jinja2_env_factory, root):
+    _worker_state['jinja2_env'] = jinja2_env_factory()
+    _worker_state['root'] = root
+    _worker_state['nodes'] = list(iter_tree(root))
+
+
+def _render_page_job(job):
+    index, layout, target_filename = job
+    # Markdown is parsed while rendering, collect the worker's timings
+    profile = profiling.get_profile()
+    if profile:
+        profile.files = {}
+    start_time = time.time()
+    dirs = render_page(_worker_state['jinja2_env'], _worker_state['root'],
+                       _worker_state['nodes'][index], layout, target_filename)
+    return (index, layout, time.time() - start_time,
+            profile.files if profile else {}, dirs)
+
+
+def render_pages(jinja2_env_factory, root, jobs, processes, cancel_event=None):
+    """Renders pages using a pool of `processes` worker processes.
+
+    Worker processes are forked after the tree has been filled, so they
+    inherit it instead of receiving pickled contexts (which are cyclic
+    because of ``PARENT`` and ``SIBLINGS`` references). Each worker creates
+    its own environment by calling `jinja2_env_factory`; pages are
+    identified by their position in :func:`iter_tree` order.
+
+    If `cancel_event` gets set, the workers are terminated
+    (see :func:`check_cancelled`).
+
+    Returns dictionary that maps node indices to the sets of the directories
+    read by the pages (see :func:`render_page`).
+
+    :param jobs: list of `(node index, layout, target filename)` tuples
+    """
+    profile = profiling.get_profile()
+    nodes = list(iter_tree(root))
+    read_dirs = {}
+    pool = multiprocessing.Pool(
+        processes, initializer=_init_worker,
+        initargs=(jinja2_env_factory, root))
+    try:
+        for index, layout, seconds, files, dirs in pool.imap_unordered(
+                _render_page_job, jobs, chunksize=16):
+            check_cancelled(cancel_event)
+            read_dirs[index] = dirs
+            if profile:
+                profile.record_page(
+                    get_page_url(root, nodes[index]), layout, seconds)
+                for (kind, path), file_seconds in files.iteritems():
+                    profile.record_file(kind, path, file_seconds)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return read_dirs
+
+
+def build_site(jinja2_env, build_dir, root, manifest=None, salt='',
+               processes=1, jinja2_env_factory=None, static_files=None,
+               cancel_event=None):
+    """Given the site tree, builds the site. Traverses the tree bottom-up and
+    for each node does the following:
+
+    1. Determines `index.html` directory (which is basically
        `build_dir`-related url of `node`);
-    3. Define which template to use based on a `LAYOUTS` setting;
-    4. Render template with node context and write result to `index.html`.
+    2. Defines which template to use (:func:`get_layout`);
+    3. Renders template with node context and writes result to `index.html`.
+
+    If `manifest` (:class:`manifest.Manifest`) is specified, every written page
+    is recorded in it along with the digest of its inputs and the directories
+    which contexts it has read (see :func:`render_page`). Pages which inputs
+    have the same digest as in the previous build are left untouched.
+
+    If `processes` is greater than 1, pages are rendered in parallel
+    by :func:`render_pages`; each worker gets it's environment from
+    `jinja2_env_factory` (workers share `jinja2_env` if it isn't specified).
+
+    Pages never overwrite static files. Those are given by `static_files` set
+    of paths; if it isn't specified, all the existing files not written by
+    the previous build are considered static.
+
+    The build stops with :class:`exceptions.BuildCancelledException` before
+    the next page once `cancel_event` is set (see :func:`check_cancelled`).
+
+    :param salt: digest of the inputs shared by all pages
     """
-    for child in node.children:
-        build_site(jinja2_env, build_dir, child, root=root or node)
+    hasher = InputHasher(jinja2_env, root.source_dir, salt=salt)
+    written = set()
+    jobs = []
 
-    if node.name == 'ROOT':
-        return
+    for index, node in enumerate(iter_tree(root)):
+        check_cancelled(cancel_event)
+        if node is root:
+            continue
 
-    path = node.get_path()
-    url = url_for(root, path, language=node.context['LANGUAGE'])
+        url = get_page_url(root, node)
 
-    target_dir = os.path.join(build_dir, url.lstrip('/'))
-    target_filename = os.path.join(target_dir, 'index.html')
+        target_dir = os.path.join(build_dir, url.lstrip('/'))
+        target_filename = os.path.normpath(
+            os.path.join(target_dir, 'index.html'))
+        relative_filename = os.path.relpath(target_filename, build_dir)
 
-    if os.path.exists(target_filename):
-        return
+        if target_filename in written:
+            continue
+        written.add(target_filename)
 
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
+        if static_files is not None:
+            is_static = target_filename in static_files
+        else:
+            is_static = os.path.exists(target_filename) and not (
+                manifest and manifest.is_known(relative_filename))
+        if is_static:
+            continue
+
+        layout = get_layout(node)
+        if manifest is not None:
+            dependencies = manifest.get_dependencies(relative_filename)
+            if dependencies is not None and os.path.exists(target_filename):
+                digest = hasher.get_page_digest(layout, dependencies)
+                if manifest.is_fresh(relative_filename, digest):
+                    manifest.record(relative_filename, digest, dependencies)
+                    continue
+
+        jobs.append((index, layout, target_filename))
+
+    if processes > 1 and len(jobs) > 1:
+        read_dirs = render_pages(jinja2_env_factory or (lambda: jinja2_env),
+                                 root, jobs, processes,
+                                 cancel_event=cancel_event)
+    else:
+        read_dirs = {}
+        profile = profiling.get_profile()
+        nodes = list(iter_tree(root))
+        for index, layout, target_filename in jobs:
+            check_cancelled(cancel_event)
+            start_time = time.time()
+            read_dirs[index] = render_page(
+                jinja2_env, root, nodes[index], layout, target_filename)
+            if profile:
+                profile.record_page(get_page_url(root, nodes[index]), layout,
+                                    time.time() - start_time)
+
+    if manifest is not None:
+        for index, layout, target_filename in jobs:
+            dependencies = hasher.get_dependencies(read_dirs[index])
+            manifest.record(os.path.relpath(target_filename, build_dir),
+                            hasher.get_page_digest(layout, dependencies),
+                            dependencies)
+
+
+def freeze_tree(root):
+    """Freezes all the nodes of the tree (see :attr:`Node.frozen`),
+    computing their paths, depths and slugs top-down in a single pass.
+    Must be called after the tree is paginated.
+    """
+    def freeze_children(node, path_prefix, depth, ancestor_slugs):
+        for child in node.children:
+            path = path_prefix + child.name
+            child.freeze(path, depth, ancestor_slugs)
+            freeze_children(
+                child, path + '/', depth + 1,
+                ancestor_slugs + (child.get_slug(intermediate=True),))
+
+    freeze_children(root, '', 1, ())
+    root.freeze('', 0, ())
+    return root
+
+
+def index_tree(root):
+    """Builds :attr:`Node.path_index` for the `root`, so that
+    :meth:`Node.find_descendant` and :func:`url_for` don't have to search
+    the tree. Must be called after the tree is paginated.
+
+    Like :meth:`Node.get_child` does, the index allows to omit names of
+    :class:`PageNode` in the paths.
+    """
+    index = {}
 
-    layout_key = path
-    if isinstance(node, PageNode):
-        layout_key = node.parent.get_path()
-    template = jinja2_env.get_template(settings.LAYOUTS[layout_key])
+    def index_children(node, prefixes):
+        for child in node.children:
+            child_paths = [prefix + child.name for prefix in prefixes]
+            for child_path in child_paths:
+                index.setdefault(child_path, child)
 
-    template.stream(ROOT=root.context, **node.context).dump(
-        target_filename, encoding='utf-8')
+            child_prefixes = [child_path + '/' for child_path in child_paths]
+            if isinstance(child, PageNode):
+                child_prefixes += prefixes
+            index_children(child, child_prefixes)
 
+    index_children(root, [''])
+    root.path_index = index
+    root.url_tables = {}
+    return root
 
-def url_for(root, path, language=None):
+
+def get_url(root, path, language=None):
     """If page at `path` exists, returns it's root-relative URL;
     otherwise throws an exception.
     """
@@ -304,47 +642,748 @@ def url_for(root, path, language=None):
     return base_url
 
 
-def build_(source_dir, build_dir, static_dir, language=None):
+def url_for(root, path, language=None):
+    """If page at `path` exists, returns it's root-relative URL;
+    otherwise throws an exception.
+
+    If the tree is indexed (see :func:`index_tree`), URLs of all the pages
+    in the given `language` are computed by :func:`get_url` on the first call
+    and then looked up in that table.
     """
-    1. Creates the tree from `source_dir` (:func:`create_tree`),
-       sorts it (:func:`sort_tree`), paginates (:func:`paginate_tree`) and
-       fills with contexts in given `language` (:func:`fill_tree`);
-    2. Tries to load translation from `./translations/<language>.po`;
-    3. Creates Jinja2 environment with webassets and i18n extensions and
-       passes it to :func:`build_site`.
+    if root.path_index is None:
+        return get_url(root, path, language=language)
+
+    urls = root.url_tables.get(language)
+    if urls is None:
+        urls = root.url_tables[language] = dict(
+            (path_, get_url(root, path_, language=language))
+            for path_ in root.path_index)
+    try:
+        return urls[path]
+    except KeyError:
+        raise UnknownPathException(path)
+
+
+def get_page_url(root, node):
+    """Returns URL of the `node` page in it's language (see :func:`url_for`)."""
+    return url_for(root, node.get_path(), language=node.context['LANGUAGE'])
+
+
+def get_salt(source_dir, tree, language=None, assets_env=None):
+    """Returns digest of the inputs shared by all pages of the `tree`:
+    settings module, translations, the tree structure itself and
+    the bundles registered in `assets_env` (their URLs are versioned,
+    see :func:`manifest.get_bundles_digest`).
     """
     source_path = lambda *args: os.path.join(source_dir, *args)
+    return hash_strings(
+        language or '',
+        hash_file(source_path('settings.py')),
+        hash_file(source_path('translations/%s.po' % language)),
+        get_bundles_digest(assets_env) if assets_env else '',
+        *[node.get_path() for node in iter_tree(tree)])
 
-    tree = create_tree(source_path('pages'), 'ROOT')
-    tree = sort_tree(tree, settings.ORDERING)
-    tree = paginate_tree(tree, settings.PAGINATION)
-    tree = fill_tree(tree, language=language)
-
-    translations = None
-    if language:
-        translations_path = source_path('translations/%s.po' % language)
-        if os.path.exists(translations_path):
-            translations = get_translations(translations_path)
 
+def create_environments(source_dir, static_dir, tree, translations=None):
+    """Creates Jinja2 environment with webassets and i18n extensions
+    for building `tree`.
+    """
     assets_env = create_assets_env(
-        source_path('static'), static_dir, settings.STATIC_URL, settings.BUNDLES)
-    jinja2_env = create_jinja2_env(
+        os.path.join(source_dir, 'static'), static_dir,
+        settings.STATIC_URL, settings.BUNDLES,
+        cache_dir=get_cache_dir('webassets'))
+    return create_jinja2_env(
         url_for=partial(url_for, tree),
         assets_env=assets_env,
         translations=translations)
 
-    build_site(jinja2_env, build_dir, tree)
 
+def build_bundles(assets_env, cache_dir=None):
+    """Builds bundles registered in `assets_env` unless they're up to date.
+
+    Bundles are built on demand when the pages are rendered, so this makes
+    sure they're up to date even if no page is going to be rendered and
+    worker processes won't build them simultaneously.
+
+    If `cache_dir` is specified, every built output is stored there under
+    the digest of it's inputs (see :func:`manifest.get_bundle_digest`) and
+    the bundles whose inputs haven't changed are copied from there instead
+    of being built again (or left untouched if the output is the same).
+    Other bundles are rebuilt if webassets finds them outdated.
+
+    Outputs are never modified in place, since they may be hardlinked to
+    the output of the previous build (see :func:`build_atomically`).
+
+    Returns a tuple `(number of rebuilt bundles, number of reused bundles)`.
+    """
+    rebuilt, reused = 0, 0
+    for bundle in assets_env:
+        digest = None
+        if cache_dir and bundle.output and not bundle.is_container:
+            digest = get_bundle_digest(bundle, assets_env)
+        if not digest:
+            # Outdated outputs are removed, so webassets builds them anew
+            outdated = 0
+            for leaf, _ in bundle.iterbuild(assets_env):
+                output = leaf.resolve_output(assets_env)
+                if not os.path.exists(output):
+                    outdated += 1
+                elif (not assets_env.updater or
+                        assets_env.updater.needs_rebuild(leaf, assets_env)):
+                    os.unlink(output)
+                    outdated += 1
+            if outdated:
+                bundle.build(assets_env)
+                rebuilt += 1
+            else:
+                reused += 1
+            continue
+
+        output = bundle.resolve_output(assets_env)
+        cached_output = os.path.join(cache_dir, digest)
+        if os.path.exists(cached_output):
+            cache.touch(cached_output)
+            if not (os.path.exists(output) and
+                    filecmp.cmp(output, cached_output, shallow=False)):
+                copy_file(cached_output, output)
+            reused += 1
+        else:
+            if os.path.exists(output):
+                # It may be hardlinked to the output of the previous build
+                os.unlink(output)
+            bundle.build(assets_env, force=True)
+            copy_file(output, cached_output)
+            rebuilt += 1
+    return rebuilt, reused
+
+
+def get_bundle_sources(bundles, assets_env):
+    """Returns set of the paths of the source files and dependencies of
+    the `bundles` and the bundles nested in them, resolved in `assets_env`.
+    """
+    sources = set()
+    bundles = list(bundles)
+    while bundles:
+        bundle = bundles.pop()
+        for _, source in bundle.resolve_contents(assets_env, force=True):
+            if isinstance(source, basestring):
+                sources.add(os.path.normpath(source))
+            else:
+                bundles.append(source)
+        sources.update(os.path.normpath(dependency)
+                       for dependency in bundle.resolve_depends(assets_env))
+    return sources
+
+
+class Site(object):
+    """Content of the project at `source_dir` prepared for building.
+
+    Keeps the inventory of the sources, filled trees and Jinja2 environments
+    between the builds, so that a long-running process
+    (see :func:`server.serve`) doesn't parse and compile anything again
+    until the sources change. Must be recreated if settings change.
+
+    .. attribute:: inventory
+
+       Inventory of the ``pages`` directory
+       (see :func:`inventory.create_inventory`).
+    """
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.inventory = None
+        self._fingerprint = None
+        self._base_contexts = None
+        self._trees = {}
+        self._jinja2_envs = {}
+        self._translations = {}
+        self._page_index = None
+        self._hashers = {}
+        self._pages = {}
+
+    def refresh(self):
+        """Rescans the ``pages`` directory and forgets the trees if any
+        of the sources have changed. Returns whether they have.
+
+        Digests of the page inputs memoized by :meth:`render_url` are
+        forgotten anyway, since layouts, translations or bundles may have
+        changed as well.
+        """
+        self._hashers = {}
+        with profiling.stage('create_inventory'):
+            inventory = create_inventory(
+                os.path.join(self.source_dir, 'pages'),
+                settings.LANGUAGES or (), threads=settings.SCAN_THREADS)
+            fingerprint = get_inventory_fingerprint(inventory)
+        if fingerprint == self._fingerprint:
+            return False
+
+        self.inventory = inventory
+        self._fingerprint = fingerprint
+        self._base_contexts = None
+        self._trees = {}
+        self._page_index = None
+        return True
+
+    def get_base_contexts(self):
+        """Returns language-neutral contexts of all the pages
+        (see :func:`utils.read_base_contexts`).
+        """
+        if self._base_contexts is None:
+            with profiling.stage('read_base_contexts'):
+                self._base_contexts = read_base_contexts(self.inventory)
+        return self._base_contexts
+
+    def get_tree(self, language=None):
+        """Creates the tree from the ``pages`` directory
+        (:func:`create_tree`), sorts it (:func:`sort_tree`), paginates
+        (:func:`paginate_tree`), freezes (:func:`freeze_tree`), indexes
+        (:func:`index_tree`) and fills with contexts in given `language`
+        (:func:`fill_tree`).
+
+        Language-neutral data is parsed once and shared between the trees
+        of all the languages; sorting by context fields uses it as well.
+        """
+        if language not in self._trees:
+            base_contexts = self.get_base_contexts()
+
+            with profiling.stage('create_tree'):
+                tree = create_tree(os.path.join(self.source_dir, 'pages'),
+                                   'ROOT', inventory=self.inventory)
+            with profiling.stage('sort_tree'):
+                tree = sort_tree(tree, settings.ORDERING,
+                                 base_contexts=base_contexts)
+            with profiling.stage('paginate_tree'):
+                tree = paginate_tree(tree, settings.PAGINATION)
+            with profiling.stage('index_tree'):
+                tree = freeze_tree(tree)
+                tree = index_tree(tree)
+            with profiling.stage('fill_tree'):
+                tree = fill_tree(tree, language=language,
+                                 base_contexts=base_contexts,
+                                 inventory=self.inventory)
+            self._trees[language] = tree
+        return self._trees[language]
+
+    def get_translations(self, language=None):
+        """Tries to load translation from `./translations/<language>.po`.
+        Translations are loaded again only if the PO file has changed.
+        """
+        if language:
+            translations_path = os.path.join(
+                self.source_dir, 'translations/%s.po' % language)
+            if os.path.exists(translations_path):
+                with profiling.stage('get_translations'):
+                    digest = hash_file(translations_path)
+                    memoized_digest, translations = self._translations.get(
+                        language, (None, None))
+                    if memoized_digest != digest:
+                        translations = get_translations(translations_path)
+                        self._translations[language] = (digest, translations)
+                    return translations
+        return None
+
+    def get_jinja2_env(self, language, static_dir):
+        """Returns Jinja2 environment with webassets and i18n extensions
+        for building the `language` tree (see :func:`create_environments`).
+        The environment is created once and then reconfigured for the current
+        tree, translations and `static_dir`.
+        """
+        tree = self.get_tree(language)
+        translations = self.get_translations(language)
+
+        with profiling.stage('create_environments'):
+            jinja2_env = self._jinja2_envs.get(language)
+            if jinja2_env is None:
+                jinja2_env = self._jinja2_envs[language] = create_environments(
+                    self.source_dir, static_dir, tree,
+                    translations=translations)
+            else:
+                jinja2_env.assets_environment.directory = static_dir
+                configure_jinja2_env(
+                    jinja2_env, url_for=partial(url_for, tree),
+                    translations=translations)
+        return jinja2_env
+
+    def get_page_index(self):
+        """Returns dictionary that maps build directory-relative URLs of
+        the pages in all the languages to `(language, node)` pairs.
+        Like :func:`build_site` does, the first page of the language tree
+        wins if several pages have the same URL.
+        """
+        if self._page_index is None:
+            page_index = {}
+            for language in settings.LANGUAGES or [None]:
+                tree = self.get_tree(language)
+                language_index = {}
+                for node in iter_tree(tree):
+                    if node is tree:
+                        continue
+                    url = get_page_url(tree, node)
+                    language_index.setdefault(url.lstrip('/'),
+                                              (language, node))
+                page_index.update(language_index)
+            self._page_index = page_index
+        return self._page_index
+
+    def get_hasher(self, language, static_dir):
+        """Returns :class:`manifest.InputHasher` for the pages of
+        the `language` tree salted with :func:`get_salt`. The hasher, and so
+        the salt and the digests of the sources and layouts, is memoized
+        until :meth:`refresh` is called.
+        """
+        if language not in self._hashers:
+            tree = self.get_tree(language)
+            jinja2_env = self.get_jinja2_env(language, static_dir)
+            self._hashers[language] = InputHasher(
+                jinja2_env, tree.source_dir,
+                salt=get_salt(self.source_dir, tree, language=language,
+                              assets_env=jinja2_env.assets_environment))
+        return self._hashers[language]
+
+    def render_url(self, url, static_dir):
+        """Renders the page at build directory-relative `url`
+        (see :meth:`get_page_index`) and returns it's HTML or ``None``
+        if there is no such page.
+
+        Rendered pages are memoized until any of their inputs change:
+        the memo is keyed by the same digest that incremental builds use
+        (:meth:`manifest.InputHasher.get_page_digest` with :func:`get_salt`),
+        computed over the directories which contexts the page has read.
+        The digests are computed again only after :meth:`refresh`, so
+        returning a memoized page doesn't touch the sources.
+        """
+        page = self.get_page_index().get(url)
+        if page is None:
+            return None
+        language, node = page
+
+        layout = get_layout(node)
+        hasher = self.get_hasher(language, static_dir)
+        digest, dependencies, html = self._pages.get(url, (None, None, None))
+        if (dependencies is not None and
+                hasher.get_page_digest(layout, dependencies) == digest):
+            return html
+
+        tree = self.get_tree(language)
+        template = self.get_jinja2_env(language, static_dir).get_template(
+            layout)
+        with record_reads() as dirs:
+            html = template.render(
+                ROOT=tree.context, **load_context(node.context))
+        html = html.encode('utf-8')
+        dependencies = hasher.get_dependencies(dirs)
+        self._pages[url] = (
+            hasher.get_page_digest(layout, dependencies), dependencies, html)
+        return html
+
+
+def build_(site, build_dir, static_dir, language=None, manifest_dir=None,
+           incremental=False, processes=1, static_files=None,
+           cancel_event=None):
+    """
+    1. Gets the `site` tree filled with contexts in given `language`
+       (see :meth:`Site.get_tree`);
+    2. Gets Jinja2 environment with webassets and i18n extensions
+       (see :meth:`Site.get_jinja2_env`) and passes it to :func:`build_site`
+       along with the number of worker `processes`.
+
+    If `manifest_dir` is specified, the manifest of written pages is stored
+    there as `<language>.json`. If `incremental` is ``True``, pages that are up
+    to date according to the previous manifest aren't rendered again and pages
+    that no longer exist are removed. Pages never overwrite `static_files`
+    (see :func:`build_site`). The build can be cancelled by `cancel_event`.
+    """
+    tree = site.get_tree(language)
+    jinja2_env = site.get_jinja2_env(language, static_dir)
+    jinja2_env_factory = partial(
+        create_environments, site.source_dir, static_dir, tree,
+        translations=site.get_translations(language))
+
+    manifest = None
+    if manifest_dir:
+        manifest = Manifest(
+            os.path.join(manifest_dir, '%s.json' % (language or 'default')))
+        if incremental:
+            manifest.load()
+
+    with profiling.stage('build_site'):
+        salt = get_salt(site.source_dir, tree, language=language,
+                        assets_env=jinja2_env.assets_environment)
+        build_site(jinja2_env, build_dir, tree, manifest=manifest, salt=salt,
+                   processes=processes, jinja2_env_factory=jinja2_env_factory,
+                   static_files=static_files, cancel_event=cancel_event)
+
+    if manifest:
+        with profiling.stage('save_manifest'):
+            for relative_filename in manifest.get_stale():
+                filename = os.path.join(build_dir, relative_filename)
+                if os.path.exists(filename):
+                    os.remove(filename)
+            manifest.save()
+
+
+def copy_file(source, target):
+    """Atomically replaces `target` with the copy of `source`."""
+    target_dir = os.path.dirname(target)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    tmp_target = '%s.%s.tmp' % (target, os.getpid())
+    shutil.copyfile(source, tmp_target)
+    os.rename(tmp_target, target)
+
+
+def sync_static(source_dir, static_dir, manifest=None, link=True):
+    """Makes `static_dir` contain the same files as `source_dir`.
+
+    Files whose size and modification time are the same as of their source
+    are left untouched. Other files are hardlinked to their sources if `link`
+    is ``True`` and the filesystem supports it; otherwise they are copied.
+    Existing files are unlinked before, so that the files hardlinked
+    to the previous build outputs are never modified.
+
+    If `manifest` is specified, synced files are recorded in it and the
+    files that were synced previously, but no longer exist in `source_dir`
+    are removed.
+
+    Returns dictionary with the numbers of ``linked``, ``copied``,
+    ``unchanged`` and ``removed`` files.
+    """
+    stats = dict.fromkeys(('linked', 'copied', 'unchanged', 'removed'), 0)
+
+    for dirpath, dirnames, filenames in os.walk(source_dir, followlinks=True):
+        target_dirpath = os.path.join(
+            static_dir, os.path.relpath(dirpath, source_dir))
+        if not os.path.exists(target_dirpath):
+            os.makedirs(target_dirpath)
+
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            target = os.path.join(target_dirpath, filename)
+            source_stat = os.stat(source)
+            if manifest is not None:
+                manifest.record(os.path.relpath(target, static_dir), '%i:%i' % (
+                    source_stat.st_size, source_stat.st_mtime))
+
+            if os.path.exists(target):
+                target_stat = os.stat(target)
+                if (target_stat.st_size == source_stat.st_size and
+                        int(target_stat.st_mtime) == int(source_stat.st_mtime)):
+                    stats['unchanged'] += 1
+                    continue
+                os.unlink(target)
+
+            if link:
+                try:
+                    os.link(source, target)
+                except OSError:
+                    pass
+                else:
+                    stats['linked'] += 1
+                    continue
+            shutil.copy2(source, target)
+            stats['copied'] += 1
+
+    if manifest is not None:
+        for relative_filename in manifest.get_stale():
+            filename = os.path.join(static_dir, relative_filename)
+            if os.path.exists(filename):
+                os.remove(filename)
+                stats['removed'] += 1
+        manifest.save()
+
+    return stats
+
+
+def link_tree(source_dir, target_dir):
+    """Recreates `source_dir` structure in `target_dir`, hardlinking
+    the files (or copying them if hardlinks aren't supported).
+    """
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        target_dirpath = os.path.join(
+            target_dir, os.path.relpath(dirpath, source_dir))
+        if not os.path.exists(target_dirpath):
+            os.makedirs(target_dirpath)
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            target = os.path.join(target_dirpath, filename)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copy2(source, target)
+
+
+def _build_in_process(*args, **kwargs):
+    try:
+        build_(*args, **kwargs)
+    except:
+        traceback.print_exc()
+        sys.exit(1)
+
+
+def build_languages(site, build_dir, static_dir, languages, processes=1,
+                    cancel_event=None, **kwargs):
+    """Builds every language from `languages` in it's own process
+    (see :func:`build_`). At most `processes` languages are built at once
+    and each of them renders the pages with an even share of `processes`
+    workers, so no more than `processes` processes render at the same time.
+
+    Waits for all of them to finish and raises :class:`BuildException`
+    if any has failed. If `cancel_event` gets set, the processes are
+    terminated (see :func:`check_cancelled`).
+    """
+    concurrency = max(1, min(processes, len(languages)))
+    kwargs['processes'] = max(1, processes // concurrency)
+
+    pending = list(languages)
+    running = []
+    failed_languages = set()
+    try:
+        while pending or running:
+            while pending and len(running) < concurrency:
+                language = pending.pop(0)
+                process = multiprocessing.Process(
+                    target=_build_in_process,
+                    args=(site, build_dir, static_dir),
+                    kwargs=dict(kwargs, language=language))
+                process.start()
+                running.append((language, process))
+
+            check_cancelled(cancel_event)
+            running[0][1].join(0.1)
+            for language, process in list(running):
+                if not process.is_alive():
+                    running.remove((language, process))
+                    if process.exitcode != 0:
+                        failed_languages.add(language)
+    except BuildCancelledException:
+        for _, process in running:
+            process.terminate()
+            process.join()
+        raise
+
+    if failed_languages:
+        raise BuildException('Failed to build languages: %s' % ', '.join(
+            language for language in languages
+            if language in failed_languages))
+
+
+def configure_cache(source_dir):
+    """Enables disk tier of the caches in `CACHE_DIR` of `source_dir`
+    if `DISK_CACHE` setting is on (see :func:`cache.configure`).
+    """
+    cache.configure(os.path.join(source_dir, settings.CACHE_DIR, 'cache')
+                    if settings.DISK_CACHE else None)
+
+
+def prune_cache(source_dir):
+    """Removes the entries of the disk cache in `CACHE_DIR` of `source_dir`
+    that haven't been used for `DISK_CACHE_MAX_AGE` days
+    (see :func:`cache.prune`). Returns the number of removed entries.
+    """
+    configure_cache(source_dir)
+    return cache.prune(settings.DISK_CACHE_MAX_AGE * 24 * 60 * 60)
+
+
+def get_static_files(static_dir, filenames):
+    """Returns set of normalized paths of the static `filenames`
+    (relative to `static_dir`).
+    """
+    return set(os.path.normpath(os.path.join(static_dir, filename))
+               for filename in filenames)
 
-def build(source_dir, build_dir):
+
+def build_static(source_dir, build_dir, manifest_dir=None, incremental=False):
+    """Syncs static files (see :func:`sync_static`) and builds bundles
+    (see :func:`build_bundles`) to the `STATIC_URL` directory of `build_dir`.
+
+    Returns a tuple of the dictionary with the statistics and the set of static
+    file paths (``None`` if `manifest_dir` isn't specified).
+    """
     static_dir = os.path.join(build_dir, settings.STATIC_URL.lstrip('/'))
-    shutil.copytree(os.path.join(source_dir, 'static'), static_dir)
+    stats = {}
+
+    static_manifest = None
+    if manifest_dir:
+        static_manifest = Manifest(os.path.join(manifest_dir, 'static.json'))
+        if incremental:
+            static_manifest.load()
+    with profiling.stage('sync_static'):
+        stats['static'] = sync_static(
+            os.path.join(source_dir, 'static'), static_dir,
+            manifest=static_manifest, link=settings.LINK_STATIC)
+    static_files = None
+    if static_manifest:
+        static_files = get_static_files(static_dir, static_manifest.current)
+
+    assets_env = create_assets_env(
+        os.path.join(source_dir, 'static'), static_dir,
+        settings.STATIC_URL, settings.BUNDLES,
+        cache_dir=get_cache_dir('webassets'))
+    with profiling.stage('build_bundles'):
+        stats['bundles_rebuilt'], stats['bundles_reused'] = build_bundles(
+            assets_env, cache_dir=get_cache_dir('bundles'))
+    return stats, static_files
+
+
+def build(source_dir, build_dir, manifest_dir=None, incremental=False,
+          processes=1, site=None, static=True, pages=True, languages=None,
+          cancel_event=None):
+    """Builds the site from `source_dir` to `build_dir` in all
+    the `LANGUAGES` (see :func:`build_`).
+
+    Static files are synced and bundles are built (see :func:`build_static`)
+    before the languages. Page directories are scanned once and
+    language-neutral content is parsed once and shared between the languages
+    (see :class:`Site`). If `processes` is greater than 1, the languages are
+    built concurrently (see :func:`build_languages`), sharing `processes`
+    between them.
+
+    Parsed Markdown and YAML, compiled templates and translations and built
+    bundles are cached in `CACHE_DIR` if `DISK_CACHE` setting is on. Trees,
+    environments and translations are kept in `site` (:class:`Site`) if it's
+    passed, so the consecutive builds only reparse what has changed.
+
+    Incremental builds can skip the stages whose sources haven't changed:
+    static files and bundles if `static` is ``False``, pages if `pages` is
+    ``False``, and languages that aren't listed in `languages` (if specified).
+
+    Setting `cancel_event` (:class:`threading.Event`) stops the build
+    with :class:`exceptions.BuildCancelledException` (see :func:`build_site`).
+
+    If build fails, `build_dir` is removed unless the build is `incremental`.
+
+    Returns dictionary with the build statistics.
+    """
+    configure_cache(source_dir)
+
+    static_dir = os.path.join(build_dir, settings.STATIC_URL.lstrip('/'))
+    kwargs = {
+        'manifest_dir': manifest_dir,
+        'incremental': incremental,
+        'processes': processes,
+        'cancel_event': cancel_event,
+    }
     try:
-        if settings.LANGUAGES:
-            for language in settings.LANGUAGES:
-                build_(source_dir, build_dir, static_dir, language=language)
+        if static or not incremental:
+            stats, kwargs['static_files'] = build_static(
+                source_dir, build_dir, manifest_dir=manifest_dir,
+                incremental=incremental)
+        else:
+            stats = {}
+            if manifest_dir:
+                static_manifest = Manifest(
+                    os.path.join(manifest_dir, 'static.json'))
+                static_manifest.load()
+                kwargs['static_files'] = get_static_files(
+                    static_dir, static_manifest.previous)
+
+        if not pages and incremental:
+            return stats
+        check_cancelled(cancel_event)
+
+        site = site or Site(source_dir)
+        site.refresh()
+
+        only_languages = languages if incremental else None
+        languages = settings.LANGUAGES
+        if languages and only_languages is not None:
+            languages = [language for language in languages
+                         if language in only_languages]
+            if not languages:
+                return stats
+
+        # Timings can't be collected from the language processes
+        if (languages and len(languages) > 1 and processes > 1 and
+                profiling.get_profile() is None):
+            # Parse language-neutral data before forking
+            site.get_base_contexts()
+            build_languages(site, build_dir, static_dir, languages, **kwargs)
+        elif languages:
+            for language in languages:
+                build_(site, build_dir, static_dir, language=language,
+                       **kwargs)
         else:
-            build_(source_dir, static_dir, build_dir)
+            build_(site, build_dir, static_dir, **kwargs)
     except:
-        shutil.rmtree(build_dir)
+        if not incremental and os.path.exists(build_dir):
+            shutil.rmtree(build_dir)
         raise
+    return stats
+
+
+def remove_in_background(path):
+    """Removes `path` directory in a separate process, so that the current
+    one can exit without waiting for it. Returns :class:`subprocess.Popen`.
+    """
+    return subprocess.Popen(
+        [sys.executable, '-c',
+         'import sys, shutil; shutil.rmtree(sys.argv[1], ignore_errors=True)',
+         path], close_fds=True)
+
+
+def build_atomically(source_dir, target_dir, manifest_dir=None, processes=1,
+                     site=None, static=True, pages=True, languages=None,
+                     cancel_event=None):
+    """Builds the site to a new `.build-<timestamp>` directory inside
+    `source_dir` and then atomically points `target_dir` symlink to it.
+
+    If `target_dir` links to the previous build and it's manifests are
+    available, the new build reuses it: all the files are hardlinked and only
+    the pages whose inputs have changed are rendered (see :func:`build`);
+    `static`, `pages` and `languages` allow to skip the stages whose sources
+    haven't changed. Manifests in `manifest_dir` are replaced only if
+    the build succeeds. The previous build directory is removed by a separate
+    process (see :func:`remove_in_background`).
+    If the build fails or is cancelled (see `cancel_event` of :func:`build`),
+    it's directory and manifests are removed and `target_dir` is left intact.
+
+    Returns the build statistics.
+    """
+    timestamp = int(time.time())
+    build_dir = os.path.join(source_dir, '.build-%s' % timestamp)
+    suffix = 0
+    while os.path.exists(build_dir):
+        suffix += 1
+        build_dir = os.path.join(source_dir, '.build-%s-%s' % (timestamp, suffix))
+
+    previous_build_dir = None
+    if os.path.islink(target_dir):
+        previous_build_dir = os.path.realpath(target_dir)
+
+    new_manifest_dir = None
+    if manifest_dir:
+        new_manifest_dir = '%s%s' % (manifest_dir, os.path.basename(build_dir))
+    reuse = bool(previous_build_dir and os.path.isdir(previous_build_dir) and
+                 manifest_dir and os.path.isdir(manifest_dir))
+
+    try:
+        if reuse:
+            link_tree(previous_build_dir, build_dir)
+            shutil.copytree(manifest_dir, new_manifest_dir)
+        stats = build(source_dir, build_dir, manifest_dir=new_manifest_dir,
+                      incremental=reuse, processes=processes, site=site,
+                      static=static, pages=pages, languages=languages,
+                      cancel_event=cancel_event)
+    except:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        if new_manifest_dir:
+            shutil.rmtree(new_manifest_dir, ignore_errors=True)
+        raise
+
+    if new_manifest_dir:
+        if os.path.exists(manifest_dir):
+            shutil.rmtree(manifest_dir)
+        os.rename(new_manifest_dir, manifest_dir)
+
+    if os.path.isdir(target_dir) and not os.path.islink(target_dir):
+        shutil.rmtree(target_dir)
+    # rename(2) atomically replaces the old symlink
+    tmp_link = os.path.join(os.path.dirname(target_dir), '.%s.%s.tmp' % (
+        os.path.basename(target_dir), os.getpid()))
+    os.symlink(build_dir, tmp_link)
+    os.rename(tmp_link, target_dir)
+
+    if previous_build_dir and os.path.isdir(previous_build_dir):
+        remove_in_background(previous_build_dir)
+    return stats
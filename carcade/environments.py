@@ -1,16 +1,66 @@
+import os
+
 import jinja2
 import webassets
 import markdown
 
 from .conf import settings
+from .cache import get_cache, get_cache_dir, touch
+from .manifest import hash_strings
+
+
+MARKDOWN_EXTENSIONS = ['extra']
+
+_markdown_parser = None
 
 
 def create_markdown_parser():
     """Creates Markdown parser with extensions."""
-    return markdown.Markdown(['extra'])
+    return markdown.Markdown(MARKDOWN_EXTENSIONS)
 
 
-def create_assets_env(source_dir, build_dir, static_url, bundles):
+def render_markdown(text):
+    """Converts Markdown `text` to HTML. Results are cached by the digest
+    of `text` and the parser configuration (see :func:`cache.get_cache`).
+    """
+    global _markdown_parser
+    key = hash_strings(
+        markdown.version, repr(MARKDOWN_EXTENSIONS), text)
+    cache = get_cache('markdown')
+    html = cache.get(key)
+    if html is None:
+        if _markdown_parser is None:
+            _markdown_parser = create_markdown_parser()
+        html = _markdown_parser.reset().convert(text)
+        cache.set(key, html)
+    return html
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """:class:`jinja2.FileSystemBytecodeCache` that can be shared by
+    concurrent processes: cache files are replaced atomically and
+    the unreadable ones are ignored. Loaded files are touched
+    (see :func:`cache.prune`).
+    """
+
+    def load_bytecode(self, bucket):
+        try:
+            super(BytecodeCache, self).load_bytecode(bucket)
+        except Exception:
+            bucket.reset()
+        if bucket.code is not None:
+            touch(self._get_cache_filename(bucket))
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        tmp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as file_:
+            bucket.write_bytecode(file_)
+        os.rename(tmp_filename, filename)
+
+
+def create_assets_env(source_dir, build_dir, static_url, bundles,
+                      cache_dir=None):
     """Creates webassets environment with registered `bundles`.
 
     :param source_dir: directory that will be searched for source files
@@ -19,6 +69,8 @@ def create_assets_env(source_dir, build_dir, static_url, bundles):
     :param static_url: root-relative static folder URL
     :param bundles: dictionary with bundle names as keys and bundles
                     (:class:`webassets.Bundle`) as values
+    :param cache_dir: directory to cache the results of the filters in
+                      (caching is disabled if it's not specified)
     """
     env = webassets.Environment()
     env.config.update({
@@ -26,7 +78,7 @@ def create_assets_env(source_dir, build_dir, static_url, bundles):
         'directory': build_dir,
         'url': static_url,
         'manifest': False,
-        'cache': False,
+        'cache': cache_dir or False,
     })
     for bundle_name, bundle in bundles.iteritems():
         env.register(bundle_name, bundle)
@@ -51,25 +103,45 @@ def create_jinja2_env(layouts_dir='layouts', url_for=None,
     Installs `translations` if specified;
     installs webassets extension with `assets_env` if specified.
 
+    Compiled templates are cached in the ``templates`` disk cache (see
+    :func:`cache.get_cache_dir`), so they're compiled again only when their
+    source changes.
+
     :param layouts_dir: path to templates directory
     :type translations: :class:`gettext.GNUTranslations`
     :type assets_env: :class:`webassets.Environment`
     """
+    bytecode_cache = None
+    bytecode_cache_dir = get_cache_dir('templates')
+    if bytecode_cache_dir:
+        bytecode_cache = BytecodeCache(bytecode_cache_dir)
+
     jinja2_env = jinja2.Environment(
         loader=jinja2.FileSystemLoader(layouts_dir),
-        extensions=['jinja2.ext.i18n', 'webassets.ext.jinja2.AssetsExtension'])
-    jinja2_env.install_null_translations(newstyle=True)
-    jinja2_env.filters['markdown'] = create_markdown_parser().convert
-
+        extensions=['jinja2.ext.i18n', 'webassets.ext.jinja2.AssetsExtension'],
+        bytecode_cache=bytecode_cache)
+    jinja2_env.filters['markdown'] = render_markdown
     jinja2_env.globals['STATIC_URL'] = settings.STATIC_URL
-    if url_for:
-        jinja2_env.globals['url_for'] = create_jinja2_url_for(url_for)
 
     # Empty webassets environment evaluates to False in boolean context
     if assets_env is not None:
         jinja2_env.assets_environment = assets_env
 
+    return configure_jinja2_env(
+        jinja2_env, url_for=url_for, translations=translations)
+
+
+def configure_jinja2_env(jinja2_env, url_for=None, translations=None):
+    """Installs `url_for` global and `translations` (null translations
+    if not specified) into `jinja2_env`. Lets to reuse the environment
+    for another tree or language.
+    """
+    if url_for:
+        jinja2_env.globals['url_for'] = create_jinja2_url_for(url_for)
+
     if translations:
         jinja2_env.install_gettext_translations(translations, newstyle=True)
+    else:
+        jinja2_env.install_null_translations(newstyle=True)
 
     return jinja2_env
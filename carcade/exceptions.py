@@ -4,3 +4,15 @@ class UnknownPathException(Exception):
 
 class UnknownOrderingException(Exception):
     pass
+
+
+class BuildException(Exception):
+    pass
+
+
+class FrozenTreeException(Exception):
+    pass
+
+
+class BuildCancelledException(Exception):
+    pass
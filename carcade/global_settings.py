@@ -10,3 +10,9 @@ BUNDLES = {}
 ORDERING = {}
 PAGINATION = {}
 PAGE_NAME = 'page%i'
+
+CACHE_DIR = '.carcade-cache'
+DISK_CACHE = True
+DISK_CACHE_MAX_AGE = 30
+SCAN_THREADS = 1
+LINK_STATIC = True
@@ -1,37 +1,138 @@
+import io
+import os
 import gettext
-import tempfile
+import multiprocessing
+from cStringIO import StringIO
 from collections import defaultdict
 
+import jinja2
 import polib
 
+from carcade.cache import get_cache
+from carcade.manifest import hash_strings, hash_file
 from carcade.utils import get_template_source
 
 
+def compile_translations(po_file_path):
+    """Returns content of the MO file compiled from PO file `po_file_path`.
+
+    Compiled catalogs are cached by the digest of the PO file
+    (see :func:`cache.get_cache`).
+    """
+    key = hash_strings(polib.__version__, hash_file(po_file_path))
+    cache = get_cache('translations')
+    mo_data = cache.get(key)
+    if mo_data is None:
+        mo_data = polib.pofile(po_file_path).to_binary()
+        cache.set(key, mo_data)
+    return mo_data
+
+
 def get_translations(po_file_path):
-    """Creates :class:`gettext.GNUTranslations` from PO file `po_file_path`."""
-    po_file = polib.pofile(po_file_path)
-    with tempfile.NamedTemporaryFile() as mo_file:
-        po_file.save_as_mofile(mo_file.name)
-        return gettext.GNUTranslations(mo_file)
+    """Creates :class:`gettext.GNUTranslations` from PO file `po_file_path`
+    (see :func:`compile_translations`).
+    """
+    return gettext.GNUTranslations(
+        StringIO(compile_translations(po_file_path)))
 
 
-def extract_translations(jinja2_env, target_pot_file):
-    """Produces a `target_pot_file` which contains a list of all
-    the translatable strings extracted from the templates.
+def parse_messages(jinja2_env, template_source):
+    """Returns list of `(lineno, message)` pairs of the translatable strings
+    from `template_source`.
     """
-    po = polib.POFile()
-    po.metadata = {'Content-Type': 'text/plain; charset=utf-8'}
+    return [(lineno, unicode(message)) for lineno, _, message
+            in jinja2_env.extract_translations(template_source)]
 
-    messages = defaultdict(list)
+
+# State of the extraction worker process (see :func:`extract_translations`)
+_worker_state = {}
+
+
+def _init_worker(jinja2_env_factory):
+    _worker_state['jinja2_env'] = jinja2_env_factory()
+
+
+def _parse_messages_job(job):
+    key, template_source = job
+    return key, parse_messages(_worker_state['jinja2_env'], template_source)
+
+
+def extract_messages(jinja2_env, processes=1, jinja2_env_factory=None):
+    """Returns dictionary that maps translatable strings from all
+    the templates of `jinja2_env` to the sorted lists of their
+    `(template, lineno)` occurrences.
+
+    Messages of each template are cached by the digest of its source
+    (see :func:`cache.get_cache`), so only the changed templates are parsed.
+    If `processes` is greater than 1, they are parsed by a pool of worker
+    processes; each worker gets it's environment from `jinja2_env_factory`
+    (workers share `jinja2_env` if it isn't specified).
+    """
+    cache = get_cache('messages')
+    template_messages = {}
+    jobs = []
     for template in jinja2_env.list_templates():
         template_source = get_template_source(jinja2_env, template)
-        for (lineno, _, message) in jinja2_env.extract_translations(template_source):
-            message = unicode(message)
-            occurence = (template, lineno)
-            messages[message].append(occurence)
+        key = hash_strings(jinja2.__version__, template_source)
+        template_messages[template] = cache.get(key)
+        if template_messages[template] is None:
+            jobs.append((template, key, template_source))
+
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(
+            processes, initializer=_init_worker,
+            initargs=(jinja2_env_factory or (lambda: jinja2_env),))
+        try:
+            parsed = dict(pool.imap_unordered(
+                _parse_messages_job,
+                [(key, template_source) for _, key, template_source in jobs]))
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        parsed = dict((key, parse_messages(jinja2_env, template_source))
+                      for _, key, template_source in jobs)
+
+    for template, key, _ in jobs:
+        template_messages[template] = parsed[key]
+        cache.set(key, parsed[key])
+
+    messages = defaultdict(list)
+    for template, occurrences in template_messages.iteritems():
+        for lineno, message in occurrences:
+            messages[message].append((template, lineno))
+    for occurrences in messages.itervalues():
+        occurrences.sort()
+    return messages
+
+
+def extract_translations(jinja2_env, target_pot_file, processes=1,
+                         jinja2_env_factory=None):
+    """Produces a `target_pot_file` which contains a list of all
+    the translatable strings extracted from the templates
+    (see :func:`extract_messages`).
+
+    Messages are sorted, so the file is the same as long as the messages
+    and their occurrences are. It isn't rewritten if it's up to date.
+    Returns whether it has been written.
+    """
+    po = polib.POFile()
+    po.metadata = {'Content-Type': 'text/plain; charset=utf-8'}
 
-    for message, occurrences in messages.iteritems():
-        entry = polib.POEntry(msgid=message, msgstr=message, occurrences=occurrences)
+    messages = extract_messages(jinja2_env, processes=processes,
+                                jinja2_env_factory=jinja2_env_factory)
+    for message in sorted(messages):
+        entry = polib.POEntry(
+            msgid=message, msgstr=message, occurrences=messages[message])
         po.append(entry)
 
+    if os.path.exists(target_pot_file):
+        with io.open(target_pot_file, encoding=po.encoding) as file_:
+            if file_.read() == unicode(po):
+                return False
     po.save(target_pot_file)
+    return True
@@ -0,0 +1,118 @@
+import os
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+SOURCE_EXTENSIONS = ('md', 'yaml')
+
+
+class DirectoryInfo(object):
+    """Contents of the page directory.
+
+    .. attribute:: subdirs
+
+       Sorted list of the subdirectory names.
+
+    .. attribute:: files
+
+       Dictionary that maps `(extension, language)` pairs to the sorted
+       lists of source file names. Language-neutral files have ``None``
+       language.
+    """
+
+    __slots__ = ('subdirs', 'files')
+
+    def __init__(self):
+        self.subdirs = []
+        self.files = {}
+
+    def get_files(self, extension, language=None):
+        """Returns names of ``<name>.<extension>`` files or, if `language`
+        is specified, ``<name>.<language>.<extension>`` files.
+        """
+        return self.files.get((extension, language), [])
+
+
+def classify_file(filename, languages=()):
+    """Returns `(extension, language)` pair for the source file `filename`
+    or ``None`` if it isn't a source file.
+
+    >>> classify_file('summary.md', ['en', 'ru'])
+    ('md', None)
+    >>> classify_file('data.ru.yaml', ['en', 'ru'])
+    ('yaml', 'ru')
+    >>> classify_file('data.fr.yaml', ['en', 'ru'])
+    ('yaml', None)
+    >>> classify_file('image.png', ['en', 'ru'])
+    """
+    if filename.startswith('.'):
+        return None
+    for extension in SOURCE_EXTENSIONS:
+        if filename.endswith('.' + extension):
+            for language in languages:
+                if filename.endswith('.%s.%s' % (language, extension)):
+                    return extension, language
+            return extension, None
+    return None
+
+
+def _iter_entries(dir_):
+    """Yields `(name, is directory)` pairs for the entries of `dir_`."""
+    if scandir is not None:
+        for entry in scandir(dir_):
+            yield entry.name, entry.is_dir()
+    else:
+        for name in os.listdir(dir_):
+            yield name, os.path.isdir(os.path.join(dir_, name))
+
+
+def scan_dir(dir_, languages=()):
+    """Lists `dir_` once and returns it's :class:`DirectoryInfo`."""
+    info = DirectoryInfo()
+    for name, is_dir in _iter_entries(dir_):
+        if is_dir:
+            info.subdirs.append(name)
+            continue
+        kind = classify_file(name, languages)
+        if kind:
+            info.files.setdefault(kind, []).append(name)
+
+    info.subdirs.sort()
+    for filenames in info.files.itervalues():
+        filenames.sort()
+    return info
+
+
+def create_inventory(root_dir, languages=(), threads=1):
+    """Walks `root_dir` and returns dictionary that maps it and all
+    it's subdirectories to their :class:`DirectoryInfo`.
+
+    Directories are listed level by level; if `threads` is greater than 1,
+    directories of the same level are listed concurrently, which pays off
+    on the network filesystems.
+    """
+    scan = lambda dir_: scan_dir(dir_, languages)
+    pool = ThreadPool(threads) if threads > 1 else None
+
+    inventory = {}
+    level = [root_dir]
+    try:
+        while level:
+            infos = pool.map(scan, level) if pool else map(scan, level)
+            next_level = []
+            for dir_, info in zip(level, infos):
+                inventory[dir_] = info
+                next_level.extend(
+                    os.path.join(dir_, name) for name in info.subdirs)
+            level = next_level
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return inventory
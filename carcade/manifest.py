@@ -0,0 +1,234 @@
+import os
+import json
+import glob
+import hashlib
+
+import jinja2.meta
+
+
+def hash_strings(*strings):
+    """Returns hex digest of the given `strings`."""
+    md5 = hashlib.md5()
+    for string in strings:
+        if isinstance(string, unicode):
+            string = string.encode('utf-8')
+        md5.update(string)
+        md5.update('\0')
+    return md5.hexdigest()
+
+
+def hash_file(path):
+    """Returns hex digest of the file at `path` or empty string
+    if it doesn't exist.
+    """
+    if not os.path.exists(path):
+        return ''
+    with open(path, 'rb') as file_:
+        return hashlib.md5(file_.read()).hexdigest()
+
+
+def get_dir_digest(dir_):
+    """Returns digest of the Markdown- and YAML-files from `dir_`."""
+    filenames = sorted(
+        glob.glob(os.path.join(dir_, '*.md')) +
+        glob.glob(os.path.join(dir_, '*.yaml')))
+    return hash_strings(*[
+        hash_strings(os.path.basename(filename), hash_file(filename))
+        for filename in filenames])
+
+
+def get_inventory_fingerprint(inventory):
+    """Returns digest of the directory structure and names, sizes and
+    modification times of the source files from the `inventory`
+    (see :func:`inventory.create_inventory`). It's a cheap way to find out
+    whether any of the sources have changed.
+    """
+    strings = []
+    for dir_ in sorted(inventory):
+        info = inventory[dir_]
+        strings.append(dir_)
+        strings.extend(info.subdirs)
+        for filenames in sorted(info.files.itervalues()):
+            for filename in filenames:
+                stat = os.stat(os.path.join(dir_, filename))
+                strings.append('%s:%i:%r' % (
+                    filename, stat.st_size, stat.st_mtime))
+    return hash_strings(*strings)
+
+
+def get_bundle_digest(bundle, assets_env):
+    """Returns digest of everything the webassets `bundle` output is built
+    from: source files, dependencies, filters and output name.
+    Returns ``None`` for bundles whose contents are nested bundles or URLs.
+    """
+    digests = [bundle.output]
+    digests.extend(str(filter_.id()) for filter_ in bundle.filters)
+    for _, source in bundle.resolve_contents(assets_env, force=True):
+        if not isinstance(source, basestring) or not os.path.isfile(source):
+            return None
+        digests.append(hash_strings(source, hash_file(source)))
+    for dependency in bundle.resolve_depends(assets_env):
+        digests.append(hash_strings(dependency, hash_file(dependency)))
+    return hash_strings(*digests)
+
+
+def get_bundles_digest(assets_env):
+    """Returns combined digest of all the bundles registered in `assets_env`
+    (see :func:`get_bundle_digest`). Bundles which inputs can't be hashed
+    are represented by their versioned URLs.
+    """
+    digests = []
+    for bundle in assets_env:
+        digest = None
+        if bundle.output and not bundle.is_container:
+            digest = get_bundle_digest(bundle, assets_env)
+        if digest is None:
+            digest = hash_strings(*bundle.urls(env=assets_env))
+        digests.append(digest)
+    return hash_strings(*digests)
+
+
+class InputHasher(object):
+    """Computes digests of the page inputs. Per-directory and per-template
+    digests are memoized, so every source file is read at most once.
+    """
+
+    def __init__(self, jinja2_env, pages_dir, salt=''):
+        """
+        :param jinja2_env: environment used to load the layouts
+        :param pages_dir: directory the page dependencies are relative to
+        :param salt: digest of the inputs shared by all pages
+                     (settings, translations, tree structure, bundles)
+        """
+        self._jinja2_env = jinja2_env
+        self._pages_dir = pages_dir
+        self._salt = salt
+        self._dir_digests = {}
+        self._template_digests = {}
+
+    def get_dir_digest(self, dir_):
+        """Returns digest of the Markdown- and YAML-files from `dir_`
+        (see :func:`get_dir_digest`).
+        """
+        if dir_ not in self._dir_digests:
+            self._dir_digests[dir_] = get_dir_digest(dir_)
+        return self._dir_digests[dir_]
+
+    def get_dependencies(self, dirs):
+        """Returns sorted list of the `dirs` relative to `pages_dir`."""
+        return sorted(os.path.relpath(dir_, self._pages_dir) for dir_ in dirs)
+
+    def get_template_digest(self, name):
+        """Returns digest of the template `name` and all the templates
+        it extends, includes or imports. If some of the references can't
+        be resolved statically, falls back to digest of all the templates.
+        """
+        if name not in self._template_digests:
+            # Guards against recursive references
+            self._template_digests[name] = ''
+            env = self._jinja2_env
+            source, _, _ = env.loader.get_source(env, name)
+            digests = [hash_strings(name, source)]
+            for reference in sorted(jinja2.meta.find_referenced_templates(
+                    env.parse(source))):
+                if reference is None:
+                    digests.append(self.get_all_templates_digest())
+                else:
+                    digests.append(self.get_template_digest(reference))
+            self._template_digests[name] = hash_strings(*digests)
+        return self._template_digests[name]
+
+    def get_all_templates_digest(self):
+        """Returns digest of all the templates known to the environment."""
+        if None not in self._template_digests:
+            env = self._jinja2_env
+            self._template_digests[None] = hash_strings(*[
+                hash_strings(name, env.loader.get_source(env, name)[0])
+                for name in sorted(env.list_templates())])
+        return self._template_digests[None]
+
+    def get_page_digest(self, layout, dependencies):
+        """Returns digest of everything the page is rendered from: the shared
+        salt, it's `layout` and the sources of it's `dependencies` --
+        the directories which contexts the page has read while being rendered
+        (see :func:`utils.record_reads` and :meth:`get_dependencies`).
+        """
+        digests = [self._salt, layout, self.get_template_digest(layout)]
+        for dependency in dependencies:
+            digests.append(dependency)
+            digests.append(self.get_dir_digest(
+                os.path.normpath(os.path.join(self._pages_dir, dependency))))
+        return hash_strings(*digests)
+
+
+class Manifest(object):
+    """On-disk record of the pages written by a build: maps their
+    build directory-relative filenames to the digests of their inputs.
+
+    .. attribute:: previous
+
+       Records loaded from disk (see :meth:`load`).
+
+    .. attribute:: current
+
+       Records made during the current build.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.previous = {}
+        self.current = {}
+
+    def load(self):
+        """Loads records left by the previous build (if any)."""
+        if os.path.exists(self.path):
+            with open(self.path) as file_:
+                self.previous = json.load(file_)
+
+    def save(self):
+        """Atomically replaces the manifest file with the current records."""
+        dir_ = os.path.dirname(self.path)
+        if not os.path.exists(dir_):
+            os.makedirs(dir_)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file_:
+            json.dump(self.current, file_, indent=0, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def record(self, filename, digest, dependencies=None):
+        """Records that `filename` has been written from the inputs with
+        given `digest`. `dependencies` are needed to compute the digest again
+        (see :meth:`InputHasher.get_page_digest`).
+        """
+        if dependencies is None:
+            self.current[filename] = digest
+        else:
+            self.current[filename] = [digest, dependencies]
+
+    def is_known(self, filename):
+        """Returns whether `filename` was written by the previous build."""
+        return filename in self.previous
+
+    def get_dependencies(self, filename):
+        """Returns dependencies of `filename` recorded by the previous build
+        or ``None`` if there are none.
+        """
+        record = self.previous.get(filename)
+        if isinstance(record, list):
+            return record[1]
+        return None
+
+    def is_fresh(self, filename, digest):
+        """Returns whether `filename` was written by the previous build from
+        the inputs with the same `digest`.
+        """
+        record = self.previous.get(filename)
+        if isinstance(record, list):
+            record = record[0]
+        return record == digest
+
+    def get_stale(self):
+        """Returns filenames written by the previous build, but not
+        by the current one.
+        """
+        return sorted(set(self.previous) - set(self.current))
@@ -0,0 +1,136 @@
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def get_cpu_time():
+    """Returns user and system CPU time of the current process."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Profile(object):
+    """Timings collected during the build.
+
+    .. attribute:: stages
+
+       Ordered dictionary that maps stage names to `[wall time, CPU time]`
+       lists. Stages that run several times (e.g. once per language) are
+       summed up.
+
+    .. attribute:: pages
+
+       List of `(seconds, url, layout)` tuples of the rendered pages.
+
+    .. attribute:: files
+
+       Dictionary that maps `(kind, path)` pairs of the parsed source files
+       to the time spent parsing them; kind is ``'md'`` or ``'yaml'``.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.pages = []
+        self.files = {}
+
+    def record_stage(self, name, wall_time, cpu_time):
+        totals = self.stages.setdefault(name, [0, 0])
+        totals[0] += wall_time
+        totals[1] += cpu_time
+
+    def record_page(self, url, layout, seconds):
+        self.pages.append((seconds, url, layout))
+
+    def record_file(self, kind, path, seconds):
+        key = (kind, path)
+        self.files[key] = self.files.get(key, 0) + seconds
+
+    def get_layout_totals(self):
+        """Returns list of `(layout, number of pages, total time)` tuples
+        sorted by the total time.
+        """
+        totals = {}
+        for seconds, _, layout in self.pages:
+            count, total = totals.get(layout, (0, 0))
+            totals[layout] = (count + 1, total + seconds)
+        return sorted(((layout, count, total)
+                       for layout, (count, total) in totals.iteritems()),
+                      key=lambda item: item[2], reverse=True)
+
+    def get_report(self, slowest=10):
+        """Returns human-readable report with the `slowest` pages and files."""
+        lines = ['Stages:%34s%10s' % ('wall', 'CPU')]
+        for name, (wall_time, cpu_time) in self.stages.iteritems():
+            lines.append('  %-30s%9.3fs%9.3fs' % (name, wall_time, cpu_time))
+
+        lines.append('Layouts:%27s%11s' % ('pages', 'total'))
+        for layout, count, total in self.get_layout_totals():
+            lines.append('  %-30s%5i%10.3fs' % (layout, count, total))
+
+        lines.append('Slowest pages:')
+        for seconds, url, layout in sorted(self.pages, reverse=True)[:slowest]:
+            lines.append('  %9.3fs  %s (%s)' % (seconds, url, layout))
+
+        for kind, title in (('md', 'Markdown'), ('yaml', 'YAML')):
+            files = sorted(((seconds, path)
+                            for (kind_, path), seconds in self.files.iteritems()
+                            if kind_ == kind), reverse=True)
+            lines.append('%s files: %i, %.3fs total, slowest:' % (
+                title, len(files), sum(seconds for seconds, _ in files)))
+            for seconds, path in files[:slowest]:
+                lines.append('  %9.3fs  %s' % (seconds, path))
+        return '\n'.join(lines)
+
+
+_profile = None
+
+
+def enable():
+    """Starts collecting timings to the new process-wide :class:`Profile`
+    and returns it.
+    """
+    global _profile
+    _profile = Profile()
+    return _profile
+
+
+def disable():
+    global _profile
+    _profile = None
+
+
+def get_profile():
+    """Returns the current :class:`Profile` or ``None``
+    if profiling is disabled.
+    """
+    return _profile
+
+
+@contextmanager
+def stage(name):
+    """Records wall and CPU time of the block as the build stage `name`."""
+    if _profile is None:
+        yield
+        return
+    start_time, start_cpu_time = time.time(), get_cpu_time()
+    try:
+        yield
+    finally:
+        _profile.record_stage(name, time.time() - start_time,
+                              get_cpu_time() - start_cpu_time)
+
+
+@contextmanager
+def parsing(kind, path):
+    """Records time of the block as the time spent parsing source file
+    at `path` (see :meth:`Profile.record_file`).
+    """
+    if _profile is None:
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        _profile.record_file(kind, path, time.time() - start_time)
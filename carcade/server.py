@@ -1,29 +1,166 @@
 import os
+import time
+import urllib
+import urlparse
 import threading
+import traceback
+import email.utils
+import SocketServer
 import SimpleHTTPServer
 import BaseHTTPServer
+from functools import partial
+from cStringIO import StringIO
 
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+from webassets.exceptions import BundleError
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from carcade.conf import settings
+from carcade.core import (
+    Site, build_atomically, build_static, configure_cache, check_cancelled,
+    get_bundle_sources, prune_cache)
+from carcade.environments import create_assets_env
+from carcade.exceptions import BuildCancelledException
+from carcade.manifest import hash_strings
+
+
+class Changes(object):
+    """Thread-safe accumulator of the changed paths."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._paths = set()
+        self._last_change_time = None
+
+    def add(self, path):
+        with self._condition:
+            self._paths.add(path)
+            self._last_change_time = time.time()
+            self._condition.notify_all()
+
+    def has_changes(self):
+        """Returns whether there are changes not returned by :meth:`wait`."""
+        with self._condition:
+            return bool(self._paths)
+
+    def wait(self, delay, timeout=None):
+        """Waits for the changes and then until no more changes occur for
+        `delay` seconds. Returns the set of changed paths and forgets them.
+        Returns empty set if nothing changes within `timeout` seconds.
+        """
+        with self._condition:
+            if not self._paths:
+                self._condition.wait(timeout)
+                if not self._paths:
+                    return set()
+            while True:
+                remaining = self._last_change_time + delay - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            paths, self._paths = self._paths, set()
+            return paths
+
+
+def classify_changes(project_dir, paths):
+    """Groups the changed `paths` by the kind of the project sources they
+    belong to: ``'pages'``, ``'layouts'``, ``'static'``, ``'translations'``,
+    ``'settings'`` or ``'other'``. Returns dictionary that maps the kinds
+    to the sets of `project_dir`-relative paths.
+
+    >>> changes = classify_changes('/site', [
+    ...     '/site/pages/about/text.md', '/site/settings.py',
+    ...     '/site/translations/ru.po', '/site/translations/messages.pot'])
+    >>> sorted(changes.items())
+    [('pages', set(['pages/about/text.md'])), ('settings', set(['settings.py'])), ('translations', set(['translations/ru.po']))]
+    """
+    changes = {}
+    for path in paths:
+        rel_path = os.path.relpath(path, project_dir)
+        head = rel_path.split(os.sep, 1)[0]
+        if rel_path == 'settings.py':
+            kind = 'settings'
+        elif head in ('pages', 'layouts', 'static'):
+            kind = head
+        elif head == 'translations':
+            # Templates of the catalogs don't affect the build
+            if not rel_path.endswith('.po'):
+                continue
+            kind = 'translations'
+        else:
+            kind = 'other'
+        changes.setdefault(kind, set()).add(rel_path)
+    return changes
+
+
+def merge_changes(changes, other_changes):
+    """Adds `other_changes` to `changes` (see :func:`classify_changes`)."""
+    for kind, paths in other_changes.iteritems():
+        changes.setdefault(kind, set()).update(paths)
+    return changes
+
+
+def get_changed_languages(changes):
+    """Returns languages which catalogs have been changed."""
+    return [os.path.splitext(os.path.basename(path))[0]
+            for path in changes.get('translations', ())]
+
+
+def affects_bundles(project_dir, paths):
+    """Returns whether any of the `project_dir`-relative static `paths` is
+    a source or a dependency of the `BUNDLES` (see
+    :func:`core.get_bundle_sources`), so the pages that embed their
+    versioned URLs have to be rendered again. If the sources can't be
+    resolved (e.g. one has been removed), assumes that it is.
+    """
+    static_dir = os.path.join(project_dir, 'static')
+    assets_env = create_assets_env(
+        static_dir, static_dir, settings.STATIC_URL, {})
+    try:
+        sources = get_bundle_sources(settings.BUNDLES.values(), assets_env)
+    except BundleError:
+        return True
+    return any(os.path.normpath(os.path.join(project_dir, path)) in sources
+               for path in paths)
+
 
 class EventHandler(FileSystemEventHandler):
     """Watches all files except those that are hidden or are in
-    the hidden directory.
+    the hidden directory, compiled Python modules and `ignored_paths`.
     """
 
-    def __init__(self, project_dir, new_changes_event):
+    def __init__(self, project_dir, changes, ignored_paths=()):
         """
         :param project_dir: project directory being watched
-        :param new_changes_event: event to be set when changes occur
-        :type new_changes_event: :class:`threading.Event`
+        :param changes: accumulator of the changed paths
+        :type changes: :class:`Changes`
+        :param ignored_paths: paths written by the build itself
         """
         self._project_dir = project_dir
-        self._new_changes_event = new_changes_event
+        self._changes = changes
+        self._ignored_paths = ignored_paths
         super(EventHandler, self).__init__()
 
     def on_any_event(self, event):
-        path = os.path.realpath(event.src_path)
+        self.on_path_changed(event.src_path)
+        if hasattr(event, 'dest_path'):
+            self.on_path_changed(event.dest_path)
+
+    def on_path_changed(self, path):
+        # Don't resolve the symlinks: `www` points to the hidden directory
+        path = os.path.abspath(path)
+        if path.endswith('.pyc') or any(
+                path == ignored_path or path.startswith(ignored_path + os.sep)
+                for ignored_path in self._ignored_paths):
+            return
         rel_path = os.path.relpath(path, self._project_dir)
 
         rest = rel_path
@@ -32,61 +169,385 @@ class EventHandler(FileSystemEventHandler):
             if head.startswith('.'):
                 return
 
-        self._new_changes_event.set()
+        self._changes.add(path)
 
 
-class Shutdowner(threading.Thread):
-    """Daemon thread that waits for the changes and then
-    shuts down the server.
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server that handles each connection in it's own daemon thread,
+    so slow clients and large files don't block the other requests.
     """
+    daemon_threads = True
 
-    def __init__(self, http_server, new_changes_event):
-        """
-        :param http_server: server to be shut down
-        :type http_server: :class:`BaseHTTPServer.HTTPServer`
-        :param new_changes_event: event to be listened to
-        :type new_changes_event: :class:`threading.Event`
+
+class RequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves files from the build the server's `www_dir` symlink points to
+    at the moment of request, so the rebuilds don't have to stop the server.
+
+    Connections are kept alive. Files are served with ``ETag`` and
+    ``Last-Modified`` headers and conditional requests are answered with
+    ``304 Not Modified``. If the client accepts it, precompressed
+    ``<file>.br`` or ``<file>.gz`` is sent instead of the file. Files larger
+    than :attr:`sendfile_threshold` are sent with :func:`sendfile`
+    if it's available.
+
+    If the server has a `site` (:class:`core.Site`), pages from it's
+    `page_index` (see :meth:`core.Site.get_page_index`) are rendered
+    on demand (see :meth:`core.Site.render_url`) and the other files
+    are served from `www_dir` without waiting for the `site` lock.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    sendfile_threshold = 64 * 1024
+    encodings = (('br', '.br'), ('gzip', '.gz'))
+
+    def translate_path(self, path):
+        path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(
+            self, path)
+        rel_path = os.path.relpath(path, os.getcwd())
+        return os.path.join(os.path.realpath(self.server.www_dir), rel_path)
+
+    def send_head(self):
+        if getattr(self.server, 'site', None) is not None:
+            path = urllib.unquote(self.path.split('?', 1)[0].split('#', 1)[0])
+            url = path.lstrip('/')
+            if url == 'index.html' or url.endswith('/index.html'):
+                url = url[:-len('index.html')]
+
+            page_index = self.server.page_index
+            if url and not url.endswith('/') and url + '/' in page_index:
+                return self.send_redirect(path + '/')
+            if url in page_index:
+                with self.server.lock:
+                    try:
+                        html = self.server.site.render_url(
+                            url, self.server.static_dir)
+                    except Exception:
+                        traceback.print_exc()
+                        self.send_error(500, 'Failed to render the page')
+                        return None
+                if html is not None:
+                    return self.send_page(html)
+
+        return self.send_file()
+
+    def send_redirect(self, location):
+        self.send_response(301)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return None
+
+    def send_page(self, html):
+        """Sends rendered `html` page (see :meth:`core.Site.render_url`)."""
+        etag = '"%s"' % hash_strings(html)
+        if self.is_not_modified(etag):
+            return self.send_not_modified(etag)
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(html)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        return StringIO(html)
+
+    def send_file(self):
+        """Sends file at the requested path or it's compressed version."""
+        parts = urlparse.urlsplit(self.path)
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            if not parts.path.endswith('/'):
+                return self.send_redirect(urlparse.urlunsplit(
+                    parts[:2] + (parts.path + '/',) + parts[3:]))
+            index = os.path.join(path, 'index.html')
+            if not os.path.isfile(index):
+                return self.list_directory(path)
+            path = index
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.send_error(404, 'File not found')
+            return None
+
+        encoding = None
+        file_path = path
+        accepted_encodings = [
+            value.split(';', 1)[0].strip()
+            for value in self.headers.get('Accept-Encoding', '').split(',')]
+        for encoding_, extension in self.encodings:
+            # Compressed file is ignored if it's older than the original one
+            if (encoding_ in accepted_encodings and
+                    os.path.isfile(path + extension) and
+                    os.path.getmtime(path + extension) >= stat.st_mtime):
+                encoding = encoding_
+                file_path = path + extension
+                break
+
+        etag = '"%x-%x-%x%s"' % (stat.st_ino, stat.st_size,
+                                 int(stat.st_mtime), encoding or '')
+        if self.is_not_modified(etag, stat.st_mtime):
+            return self.send_not_modified(etag, stat.st_mtime)
+
+        try:
+            file_ = open(file_path, 'rb')
+        except IOError:
+            self.send_error(404, 'File not found')
+            return None
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', self.guess_type(path))
+            self.send_header(
+                'Content-Length', str(os.fstat(file_.fileno()).st_size))
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('ETag', etag)
+            self.send_header(
+                'Last-Modified', self.date_time_string(stat.st_mtime))
+            self.end_headers()
+            return file_
+        except:
+            file_.close()
+            raise
+
+    def is_not_modified(self, etag, mtime=None):
+        """Returns whether the client has the current version of the resource
+        according to ``If-None-Match`` or ``If-Modified-Since`` headers.
         """
-        super(Shutdowner, self).__init__()
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            etags = [tag.strip() for tag in if_none_match.split(',')]
+            return etag in etags or '*' in etags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and mtime is not None:
+            date = email.utils.parsedate_tz(if_modified_since)
+            if date:
+                return int(mtime) <= email.utils.mktime_tz(date)
+        return False
+
+    def send_not_modified(self, etag, mtime=None):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        if mtime is not None:
+            self.send_header('Last-Modified', self.date_time_string(mtime))
+        self.end_headers()
+        return None
+
+    def copyfile(self, source, outputfile):
+        if sendfile is None or not hasattr(source, 'fileno'):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(
+                self, source, outputfile)
+
+        size = os.fstat(source.fileno()).st_size
+        if size < self.sendfile_threshold:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(
+                self, source, outputfile)
+
+        outputfile.flush()
+        offset = 0
+        while offset < size:
+            sent = sendfile(self.connection.fileno(), source.fileno(),
+                            offset, size - offset)
+            if not sent:
+                break
+            offset += sent
+
+
+class BuildThread(threading.Thread):
+    """Daemon thread that calls `target` (:func:`core.build_atomically` or
+    :func:`build_lazily`) with `cancel_event` and stores it's result.
+
+    .. attribute:: stats
+
+       Build statistics if the build has succeeded.
+
+    .. attribute:: error
+
+       Exception if the build has failed or has been cancelled.
+    """
+
+    def __init__(self, target):
+        super(BuildThread, self).__init__()
         self.daemon = True
-        self._http_server = http_server
-        self._new_changes_event = new_changes_event
+        self.cancel_event = threading.Event()
+        self._build = target
+        self.stats = None
+        self.error = None
+        self.traceback = None
 
     def run(self):
-        while True:
-            self._new_changes_event.wait()
-            self._http_server.shutdown()
-            self._new_changes_event.clear()
+        try:
+            self.stats = self._build(cancel_event=self.cancel_event)
+        except Exception as e:
+            self.error = e
+            self.traceback = traceback.format_exc()
+
+
+def refresh_site(http_server, site):
+    """Rescans the sources of the `site` (see :meth:`core.Site.refresh`)
+    and updates the index of the pages `http_server` renders.
+    """
+    with http_server.lock:
+        site.refresh()
+        http_server.page_index = site.get_page_index()
+
 
+def build_lazily(http_server, project_dir, site, cancel_event=None):
+    """Builds static files and bundles of the `site` and lets `http_server`
+    render it's pages on demand (see :class:`RequestHandler`).
+    Returns the build statistics.
 
-def serve(host='localhost', port=8000):
+    Static files aren't built page by page, so `cancel_event` is only checked
+    before the build.
+    """
+    check_cancelled(cancel_event)
+    build_dir = os.path.join(project_dir, settings.CACHE_DIR, 'lazy')
+    manifest_dir = os.path.join(
+        project_dir, settings.CACHE_DIR, 'manifests', 'lazy')
+
+    with http_server.lock:
+        configure_cache(project_dir)
+        stats, _ = build_static(
+            project_dir, build_dir, manifest_dir=manifest_dir,
+            incremental=os.path.exists(build_dir))
+        site.refresh()
+
+        http_server.www_dir = build_dir
+        http_server.static_dir = os.path.join(
+            build_dir, settings.STATIC_URL.lstrip('/'))
+        http_server.page_index = site.get_page_index()
+        http_server.site = site
+    return stats
+
+
+def serve(host='localhost', port=8000, lazy=False, delay=0.5):
     """Runs the development server at given `host` and `port`,
     watches the changes and regenerates the site.
-    """
-    http_server = BaseHTTPServer.HTTPServer(
-        (host, port), SimpleHTTPServer.SimpleHTTPRequestHandler)
 
-    # Event to be set when the project has changes and needs to be rebuilt
-    new_changes_event = threading.Event()
+    The server keeps running while the site is rebuilt in the same process:
+    parsed pages, trees and environments are kept between the rebuilds
+    (see :class:`core.Site`) and are recreated only if ``settings.py``
+    changes. If the rebuild fails, the previous build is still served.
 
-    # Both `shutdowner` and `observer` are daemon threads
-    shutdowner = Shutdowner(http_server, new_changes_event)
-    shutdowner.start()
+    Changes are collected until none occur for `delay` seconds and then
+    the site is rebuilt once. Only the stages affected by the changes are
+    run (see :func:`classify_changes` and :func:`core.build`); pages are
+    rendered after static changes only if the bundles' sources have changed
+    (see :func:`affects_bundles`). The build
+    runs in background (see :class:`BuildThread`); if new changes occur
+    meanwhile, it's cancelled and started over with all the changes.
 
-    observer = Observer()
-    observer.start()
+    Unused disk cache entries are pruned whenever settings are loaded
+    (see :func:`core.prune_cache`).
+
+    If `lazy` is ``True``, only static files and bundles are built
+    (to ``<CACHE_DIR>/lazy``) and pages are rendered when requested;
+    other changes only make the site rescan it's sources
+    (see :func:`refresh_site`).
+    """
+    from carcade.cli import print_stats  # To resolve a circular import
 
     project_dir = os.getcwd()
     www_dir = os.path.join(project_dir, 'www')
-    event_handler = EventHandler(project_dir, new_changes_event)
+
+    http_server = HTTPServer((host, port), RequestHandler)
+    http_server.www_dir = www_dir
+    http_server.site = None
+    http_server.page_index = {}
+    http_server.lock = threading.Lock()
+    server_thread = threading.Thread(target=http_server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    changes = Changes()
+    observer = Observer()
+    observer.daemon = True
+    observer.start()
+    event_handler = EventHandler(project_dir, changes,
+                                 ignored_paths=(www_dir,))
     observer.schedule(event_handler, path=project_dir, recursive=True)
 
-    from carcade.cli import build  # To resolve a circular import
-    while True:
-        os.chdir(project_dir)
-        build(to=www_dir, atomically=True)
-        if not os.path.exists(www_dir):
-            return 1
-        os.chdir(www_dir)
+    site = None
+    build_thread = None
+    batch = {'settings': set()}  # Build everything at start
+    try:
+        while True:
+            # Waiting with timeout lets KeyboardInterrupt through
+            merge_changes(batch, classify_changes(
+                project_dir, changes.wait(delay, timeout=0 if batch else 1)))
+            if not batch:
+                continue
+            if site is None:
+                batch['settings'] = set()
+            current_batch, batch = batch, {}
+
+            kinds = set(current_batch)
+            full = bool(kinds & set(['settings', 'other']))
+            static = full or 'static' in kinds
+            if lazy and not static:
+                # Pages are rendered again when they're requested
+                try:
+                    refresh_site(http_server, site)
+                except Exception:
+                    print 'Ooops...'
+                    traceback.print_exc()
+                continue
+
+            print 'Build...'
+            try:
+                if 'settings' in kinds:
+                    site = None
+                    settings.configure('settings')
+                    prune_cache(project_dir)
+                    site = Site(project_dir)
+            except Exception:
+                print 'Ooops...'
+                traceback.print_exc()
+                continue
+
+            if lazy:
+                target = partial(build_lazily, http_server, project_dir, site)
+            else:
+                manifest_dir = os.path.join(
+                    project_dir, settings.CACHE_DIR, 'manifests', 'www')
+                languages = None
+                if kinds == set(['translations']):
+                    languages = get_changed_languages(current_batch)
+                # Pages embed versioned URLs of the bundles
+                pages = full or bool(
+                    kinds & set(['pages', 'layouts', 'translations']) or
+                    static and affects_bundles(
+                        project_dir, current_batch['static']))
+                target = partial(
+                    build_atomically, project_dir, www_dir,
+                    manifest_dir=manifest_dir, site=site, static=static,
+                    pages=pages, languages=languages)
+            build_thread = BuildThread(target)
+            build_thread.start()
+
+            # Cancel the build as soon as new changes arrive
+            while build_thread.is_alive():
+                build_thread.join(0.1)
+                if changes.has_changes():
+                    build_thread.cancel_event.set()
 
-        http_server.serve_forever()
+            if isinstance(build_thread.error, BuildCancelledException):
+                print 'Cancelled.'
+                # Start over with all the changes
+                merge_changes(batch, current_batch)
+            elif build_thread.error:
+                print 'Ooops...'
+                print build_thread.traceback
+            else:
+                print_stats(build_thread.stats)
+                print 'Done.'
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if build_thread and build_thread.is_alive():
+            # Let the build clean up after itself
+            build_thread.cancel_event.set()
+            build_thread.join()
+        observer.stop()
+        http_server.shutdown()
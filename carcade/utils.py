@@ -1,32 +1,118 @@
 import os
 import re
-import glob
 import subprocess
 import codecs
-import itertools
+import threading
+from functools import partial
+from contextlib import contextmanager
 
 import yaml
 
+from carcade import profiling
+from carcade.cache import get_cache
 from carcade.conf import settings
-from carcade.environments import create_markdown_parser
+from carcade.manifest import hash_strings
+from carcade.environments import render_markdown
+from carcade.inventory import scan_dir
+
+try:
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
+
+
+# Constructs that depend on the group numbers or change the flags of
+# the whole pattern, so the regexp can't be a part of an alternation
+_UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[iLmsux]+\)')
+
+# Python 2 regexps can't have more than 100 groups
+_MAX_GROUPS = 99
+
+
+def combine_regexes(regexes):
+    """Splits the list of compiled `regexes` into chunks and combines
+    each chunk into a single alternation, in which the first matching
+    alternative wins. Returns list of `(regexp, markers, index)` tuples:
+
+    * for a combined regexp, `markers` maps the number of the group that is
+      the last to match if the alternative matches to the index of that
+      alternative in `regexes` and `index` is ``None``;
+    * regexps that are left as they are (those with backreferences or
+      inline flags) have `markers` ``None`` and their own `index`.
+
+    Trying the regexps in the list order gives the first matching one.
+    """
+    default_flags = re.compile('').flags
+    chunks = []
+    chunk, groups = [], 0
+    for index, regex in enumerate(regexes):
+        combinable = (regex.flags == default_flags and
+                      regex.groups + 1 <= _MAX_GROUPS and
+                      not _UNCOMBINABLE_RE.search(regex.pattern))
+        if chunk and (not combinable or
+                      groups + regex.groups + 1 > _MAX_GROUPS):
+            chunks.append(chunk)
+            chunk, groups = [], 0
+        if combinable:
+            chunk.append((index, regex))
+            groups += regex.groups + 1
+        else:
+            chunks.append([(index, regex)])
+    if chunk:
+        chunks.append(chunk)
+
+    matchers = []
+    for chunk in chunks:
+        if len(chunk) == 1:
+            index, regex = chunk[0]
+            matchers.append((regex, None, index))
+            continue
+        alternatives, markers, groups = [], {}, 0
+        for index, regex in chunk:
+            alternatives.append('(?:%s)()' % regex.pattern)
+            groups += regex.groups + 1
+            markers[groups] = index
+        try:
+            matchers.append((re.compile('|'.join(alternatives)), markers, None))
+        except re.error:
+            # E.g. the same group names in different regexps
+            matchers.extend((regex, None, index) for index, regex in chunk)
+    return matchers
 
 
 class RegexResolver(object):
     """Provides the facility to return the first matched value from the list
     of `(regexp, value)` pairs.
+
+    Regexps are combined into a few alternations (see :func:`combine_regexes`),
+    so a lookup usually takes a single match, and the results are memoized
+    per key.
     """
     def __init__(self, items):
         """
         :param items: List of tuples `(compiled regexp, value)`
         """
         self.items = items
+        self._matchers = combine_regexes([regex for regex, _ in items])
+        self._memo = {}
+
+    def _find(self, key):
+        """Returns index of the first matched item or ``None``."""
+        for regex, markers, index in self._matchers:
+            match = regex.match(key)
+            if match:
+                return index if markers is None else markers[match.lastindex]
+        return None
 
     def __getitem__(self, key):
         """Returns the first matched value or raises :class:`KeyError`."""
-        for regex, value in self.items:
-            if regex.match(key):
-                return value
-        raise KeyError(key)
+        try:
+            index = self._memo[key]
+        except KeyError:
+            index = self._memo[key] = self._find(key)
+        if index is None:
+            raise KeyError(key)
+        return self.items[index][1]
 
     def get(self, key, default=None):
         """Returns the first matched value or `default`.
@@ -78,15 +164,64 @@ def sort(list_, order, key=None):
     ...      key=lambda el: el[0])  # Sort tuples by first element
     [('b', 2), ('a', 1)]
     """
+    # The first occurrence wins, like with `order.index`
+    ranks = {}
+    for rank, k in enumerate(order):
+        ranks.setdefault(k, rank)
+
     def key_(el):
         k = key(el) if key else el
-        if k in order:
-            return order.index(k)
-        else:
-            return len(order) + 1
+        return ranks.get(k, len(order) + 1)
     return sorted(list_, key=key_)
 
 
+class ContextOrdering(object):
+    """Ordering of the nodes by the values of their context `fields`
+    (see :func:`order_by`).
+    """
+    def __init__(self, fields, reverse=False):
+        self.fields = fields
+        self.reverse = reverse
+
+    def sort(self, list_, get_context):
+        """Sorts `list_` by the `fields` of the contexts returned
+        by `get_context` for its elements. Elements which contexts lack
+        any of the fields keep their order and go last.
+
+        >>> ordering = ContextOrdering(('date', 'title'), reverse=True)
+        >>> ordering.sort([{'date': 1, 'title': 'a'}, {'title': 'b'},
+        ...                {'date': 2, 'title': 'c'}, {'date': 1, 'title': 'd'}],
+        ...               get_context=lambda el: el)  # doctest: +NORMALIZE_WHITESPACE
+        [{'date': 2, 'title': 'c'}, {'date': 1, 'title': 'd'},
+         {'date': 1, 'title': 'a'}, {'title': 'b'}]
+        """
+        keyed, rest = [], []
+        for el in list_:
+            context = get_context(el)
+            if all(field in context for field in self.fields):
+                keyed.append(
+                    (tuple(context[field] for field in self.fields), el))
+            else:
+                rest.append(el)
+        keyed.sort(key=lambda item: item[0], reverse=self.reverse)
+        return [el for _, el in keyed] + rest
+
+
+def order_by(*fields, **kwargs):
+    """Helper to create :class:`ContextOrdering`. Example:
+
+    ::
+
+        ORDERING = {
+            'news': order_by('date', reverse=True),
+            'team': order_by('position', 'last_name'),
+        }
+
+    :param reverse: whether to sort in descending order
+    """
+    return ContextOrdering(fields, reverse=kwargs.pop('reverse', False))
+
+
 def paginate(items, items_per_page):
     """Splits `items` list into lists of size `items_per_page`.
 
@@ -105,16 +240,209 @@ def paginate(items, items_per_page):
     return result
 
 
-def yield_files(dir_, suffix, exclude_extensions=()):
-    """Yields files from `directory` which name ends with `suffix`."""
-    for filename in glob.glob(os.path.join(dir_, '*' + suffix)):
-        if any(filename.endswith(ext) for ext in exclude_extensions):
-            continue
-        with codecs.open(filename, 'r', 'utf-8') as file_:
-            yield file_
+def load_yaml(text):
+    """Parses YAML `text` with the safe loader (libyaml-based one if PyYAML
+    is built with it). Parsed data is cached by the digest of `text`
+    (see :func:`cache.get_cache`).
+    """
+    key = hash_strings(yaml.__version__, YAMLLoader.__name__, text)
+    cache = get_cache('yaml')
+    data = cache.get(key)
+    if data is None:
+        data = yaml.load(text, Loader=YAMLLoader)
+        cache.set(key, data)
+    return data
+
+
+class Lazy(object):
+    """Value that is computed by calling `loader` the first time it's
+    needed and then memoized (see :class:`LazyContext`).
+    """
+    __slots__ = ('loader', 'value')
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def get(self):
+        if self.loader is not None:
+            self.value = self.loader()
+            self.loader = None
+        return self.value
+
+
+# Directories which contexts are read by the current thread
+# (see :func:`record_reads`)
+_reads = threading.local()
+
+
+@contextmanager
+def record_reads():
+    """Records source directories of the :class:`LazyContext` instances
+    which keys are read by the current thread within the block. Yields
+    the set they're added to.
+
+    >>> context = LazyContext(a=1)
+    >>> context._source_dir = '/pages/a'
+    >>> with record_reads() as dirs:
+    ...     value = context['a']
+    >>> dirs
+    set(['/pages/a'])
+    """
+    previous_dirs = getattr(_reads, 'dirs', None)
+    _reads.dirs = dirs = set()
+    try:
+        yield dirs
+    finally:
+        _reads.dirs = previous_dirs
+
+
+class LazyContext(dict):
+    """Dictionary that computes :class:`Lazy` values when they're read,
+    so that the values that no template uses are never computed.
+
+    Reads of the contexts created by :func:`read_context` are recorded
+    (see :func:`record_reads`), so that it's known which sources a page
+    depends on.
+
+    >>> context = LazyContext(a=Lazy(lambda: 1), b=2)
+    >>> context['a'], context.get('a'), sorted(context.items())
+    (1, 1, [('a', 1), ('b', 2)])
+    """
+
+    # Directory the context is read from
+    _source_dir = None
 
+    def _record_read(self):
+        dirs = getattr(_reads, 'dirs', None)
+        if dirs is not None and self._source_dir is not None:
+            dirs.add(self._source_dir)
 
-def read_context(dir_, language=None):
+    def __getitem__(self, key):
+        self._record_read()
+        value = dict.__getitem__(self, key)
+        if isinstance(value, Lazy):
+            value = value.get()
+        return value
+
+    def __contains__(self, key):
+        self._record_read()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self._record_read()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._record_read()
+        return dict.__len__(self)
+
+    def __repr__(self):
+        return repr(load_context(self))
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return list(self)
+
+    def iterkeys(self):
+        return iter(self)
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        context = LazyContext(self)
+        context._source_dir = self._source_dir
+        return context
+
+
+def load_context(context):
+    """Returns plain dictionary with all the values of :class:`LazyContext`
+    computed. Unlike the context itself, it can be unpacked as keyword
+    arguments.
+    """
+    return dict(context.iteritems())
+
+
+def read_files(dir_, filenames):
+    """Yields contents of the files with given `filenames` from `dir_`
+    as `(filename, text)` pairs.
+    """
+    for filename in filenames:
+        with codecs.open(os.path.join(dir_, filename), 'r', 'utf-8') as file_:
+            yield filename, file_.read()
+
+
+def load_markdown(path):
+    """Reads Markdown file at `path` and converts it to HTML
+    (see :func:`environments.render_markdown`).
+    """
+    dir_, filename = os.path.split(path)
+    for _, text in read_files(dir_, [filename]):
+        with profiling.parsing('md', path):
+            return render_markdown(text)
+
+
+def read_markdown(dir_, filenames, context):
+    """Puts :class:`Lazy` values that load Markdown files with given
+    `filenames` from `dir_` (see :func:`load_markdown`) into `context`
+    under the `<name>` keys.
+    """
+    for filename in filenames:
+        var_name, suffix = filename.split('.', 1)
+        context[var_name] = Lazy(
+            partial(load_markdown, os.path.join(dir_, filename)))
+
+
+def read_base_context(dir_, info=None):
+    """Parses language-neutral Markdown and YAML files from `dir_`
+    (see :func:`read_context`).
+
+    Returns a tuple of two dictionaries: Markdown data and YAML data.
+    Markdown files are parsed lazily (see :func:`read_markdown`).
+    """
+    info = info or scan_dir(dir_, settings.LANGUAGES or ())
+
+    md_context = {}
+    read_markdown(dir_, info.get_files('md'), md_context)
+
+    yaml_context = {}
+    for filename, text in read_files(dir_, info.get_files('yaml')):
+        with profiling.parsing('yaml', os.path.join(dir_, filename)):
+            data = load_yaml(text)
+        if data:
+            yaml_context.update(data)
+
+    return md_context, yaml_context
+
+
+def read_base_contexts(inventory):
+    """Returns dictionary that maps every directory from the `inventory`
+    (see :func:`inventory.create_inventory`) to it's base context
+    (see :func:`read_base_context`).
+    """
+    base_contexts = {}
+    for dir_, info in inventory.iteritems():
+        base_contexts[dir_] = read_base_context(dir_, info=info)
+    return base_contexts
+
+
+def read_context(dir_, language=None, base_context=None, info=None):
     """Searches `dir_` for markdown- and yaml-files and returns context
     dictionary with parsed data.
 
@@ -126,28 +454,35 @@ def read_context(dir_, language=None):
     `<name>` key. Then parses each YAML file and updates context with resulting
     dictionary (note: update will override markdown data if there are
     duplicate keys).
+
+    Language-neutral files are parsed by :func:`read_base_context`, unless
+    it's result is passed as `base_context`. In that case only
+    language-specific files are parsed and the returned context shares
+    the values with `base_context`.
+
+    Files are looked up in `info` (:class:`inventory.DirectoryInfo`) if it's
+    specified; otherwise `dir_` is listed.
+
+    Returns :class:`LazyContext`: Markdown files are parsed only when their
+    keys are read (e.g. by a template) for the first time, and the reads are
+    recorded (see :func:`record_reads`).
     """
-    context = {}
+    info = info or scan_dir(dir_, settings.LANGUAGES or ())
+    md_context, yaml_context = base_context or read_base_context(dir_, info)
+    context = LazyContext(md_context)
+    context._source_dir = dir_
 
-    md_files = yield_files(
-        dir_, '.md', exclude_extensions=['.{}.md'.format(lang) for lang in settings.LANGUAGES])
-    md_parser = create_markdown_parser()
     if language:
-        lang_specific_md_files = yield_files(dir_, '.%s.md' % language)
-        md_files = itertools.chain(md_files, lang_specific_md_files)
-    for md_file in md_files:
-        var_name, suffix = os.path.basename(md_file.name).split('.', 1)
-        context[var_name] = md_parser.convert(md_file.read())
-
-    yaml_files = yield_files(
-        dir_, '.yaml', exclude_extensions=['.{}.yaml'.format(lang) for lang in settings.LANGUAGES])
+        read_markdown(dir_, info.get_files('md', language), context)
+
+    context.update(yaml_context)
+
     if language:
-        lang_specific_yaml_files = yield_files(dir_, '.%s.yaml' % language)
-        yaml_files = itertools.chain(yaml_files, lang_specific_yaml_files)
-    for yaml_file in yaml_files:
-        data = yaml.load(yaml_file.read())
-        if data:
-            context.update(data)
+        for filename, text in read_files(dir_, info.get_files('yaml', language)):
+            with profiling.parsing('yaml', os.path.join(dir_, filename)):
+                data = load_yaml(text)
+            if data:
+                context.update(data)
 
     return context
 
@@ -1 +1 @@
-nosetests carcade tests --with-doctest --verbosity=2 --with-coverage --cover-package carcade
+nosetests carcade tests benchmarks --with-doctest --verbosity=2 --with-coverage --cover-package carcade
@@ -0,0 +1,53 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from carcade import cache
+from carcade.conf import settings
+from benchmarks.generator import generate_site
+from benchmarks.runner import time_stages
+
+
+class BenchmarksTest(unittest.TestCase):
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.previous_settings = dict(settings.__dict__)
+        self.project_dir = tempfile.mkdtemp()
+        os.chdir(self.project_dir)
+        sys.path.insert(0, self.project_dir)
+
+    def tearDown(self):
+        settings.__dict__.clear()
+        settings.__dict__.update(self.previous_settings)
+        cache.configure(None)
+        os.chdir(self.previous_dir)
+        sys.path.remove(self.project_dir)
+        sys.modules.pop('settings', None)
+        shutil.rmtree(self.project_dir)
+
+    def test_generate_site(self):
+        paths = generate_site(self.project_dir, pages=20, depth=2,
+                              pagination=2, ordering='explicit', languages=2,
+                              markdown_size=100, bundles=1)
+        self.assertEqual(len(paths), 20)
+        for path in paths:
+            page_dir = os.path.join(self.project_dir, 'pages', path)
+            self.assertEqual(
+                sorted(filename for filename in os.listdir(page_dir)
+                       if filename.endswith(('.md', '.yaml'))),
+                ['data.ru.yaml', 'data.yaml', 'text.md', 'text.ru.md'])
+
+        settings.configure('settings')
+        self.assertEqual(settings.LANGUAGES, ['en', 'ru'])
+
+        timings = time_stages(self.project_dir, paths, runs=1)
+        self.assertEqual(sorted(timings), [
+            'build', 'build_site', 'create_inventory', 'create_tree',
+            'fill_tree', 'incremental_build', 'paginate_tree',
+            'read_base_contexts', 'sort_tree', 'url_for'])
+        self.assertTrue(all(len(durations) == 1
+                            for durations in timings.itervalues()))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.project_dir, 'www', 'ru', 'p0', 'p0', 'index.html')))
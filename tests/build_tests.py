@@ -0,0 +1,486 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from webassets import Bundle
+
+from carcade import cache, core, profiling
+from carcade.conf import settings
+from carcade.exceptions import BuildCancelledException
+from carcade.core import Site, build, build_atomically
+from carcade.utils import patterns
+
+
+class BuildTest(unittest.TestCase):
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.project_dir = os.path.join(tempfile.mkdtemp(), 'project')
+        shutil.copytree('./tests/fixtures/project', self.project_dir)
+        os.chdir(self.project_dir)
+
+        self.build_dir = os.path.join(self.project_dir, 'www')
+        self.manifest_dir = os.path.join(self.project_dir, '.carcade-cache')
+
+        self.previous_layouts = settings.LAYOUTS
+        self.previous_ordering = settings.ORDERING
+        settings.LAYOUTS = patterns((r'^.*$', 'page.html'))
+        settings.ORDERING = {'blog': 'alphabetically'}
+
+    def tearDown(self):
+        settings.LAYOUTS = self.previous_layouts
+        settings.ORDERING = self.previous_ordering
+        cache.configure(None)
+        os.chdir(self.previous_dir)
+        shutil.rmtree(os.path.dirname(self.project_dir))
+
+    def build(self, incremental=False, processes=1):
+        return build(self.project_dir, self.build_dir,
+              manifest_dir=self.manifest_dir, incremental=incremental,
+              processes=processes)
+
+    def read_pages(self):
+        pages = {}
+        for dirpath, _, filenames in os.walk(self.build_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with open(path) as file_:
+                    pages[os.path.relpath(path, self.build_dir)] = file_.read()
+        return pages
+
+    def read_page(self, path):
+        with open(os.path.join(self.build_dir, path, 'index.html')) as file_:
+            return file_.read()
+
+    def page_mtime(self, path):
+        return os.path.getmtime(
+            os.path.join(self.build_dir, path, 'index.html'))
+
+    def test_build(self):
+        self.build()
+        self.assertEqual(
+            self.read_page('blog'),
+            'Blog<a href="/blog/a/">a</a><a href="/blog/b/">b</a>')
+        self.assertEqual(
+            self.read_page('about'), '<p>About <em>us</em></p>')
+        self.assertTrue(
+            os.path.exists(os.path.join(self.build_dir, 'style.css')))
+
+    def test_incremental_build(self):
+        self.build()
+        # Make sure mtime changes for the rewritten files
+        for path in ('about', 'blog', 'blog/a', 'blog/b'):
+            filename = os.path.join(self.build_dir, path, 'index.html')
+            os.utime(filename, (0, 0))
+
+        with open('pages/blog/a/text.md', 'w') as file_:
+            file_.write('Edited post')
+        self.build(incremental=True)
+
+        self.assertEqual(self.read_page('blog/a'), '<p>Edited post</p>')
+        # Parent reads the changed context, siblings don't
+        self.assertNotEqual(self.page_mtime('blog'), 0)
+        self.assertEqual(self.page_mtime('blog/b'), 0)
+        self.assertEqual(self.page_mtime('about'), 0)
+
+        shutil.rmtree('pages/blog/b')
+        self.build(incremental=True)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.build_dir, 'blog/b/index.html')))
+        self.assertEqual(
+            self.read_page('blog'), 'Blog<a href="/blog/a/">a</a>')
+
+    def assert_same_as_full_build(self):
+        pages = self.read_pages()
+        shutil.rmtree(self.build_dir)
+        self.build()
+        self.assertEqual(pages, self.read_pages())
+
+    def write_deep_page(self):
+        """Adds `blog/a/deep` page with a layout that reads the root
+        and the grandparent contexts.
+        """
+        os.makedirs('pages/blog/a/deep')
+        with open('pages/blog/a/deep/text.md', 'w') as file_:
+            file_.write('Deep')
+        with open('pages/site.yaml', 'w') as file_:
+            file_.write('sitename: One')
+        with open('layouts/deep.html', 'w') as file_:
+            file_.write(
+                '{{ ROOT.sitename }}|'
+                '{% for child in ROOT.CHILDREN %}{{ child.title }},{% endfor %}|'
+                '{{ PARENT.PARENT.title }}')
+        settings.LAYOUTS = patterns((r'^blog/a/deep$', 'deep.html'),
+                                    (r'^.*$', 'page.html'))
+
+    def edit_root_and_blog(self):
+        with open('pages/site.yaml', 'w') as file_:
+            file_.write('sitename: Two')
+        with open('pages/blog/data.yaml', 'w') as file_:
+            file_.write('title: Journal')
+
+    def test_incremental_build_of_deep_page(self):
+        self.write_deep_page()
+        self.build()
+        self.assertEqual(self.read_page('blog/a/deep'), 'One|,Blog,|Blog')
+
+        self.edit_root_and_blog()
+        self.build(incremental=True)
+        self.assertEqual(
+            self.read_page('blog/a/deep'), 'Two|,Journal,|Journal')
+
+    def test_incremental_build_of_distant_dependency(self):
+        os.makedirs('pages/blog/a/c1')
+        with open('pages/blog/a/c1/text.md', 'w') as file_:
+            file_.write('One')
+        with open('layouts/tree.html', 'w') as file_:
+            file_.write(
+                '{% for section in ROOT.CHILDREN %}'
+                '{% for item in section.CHILDREN %}'
+                '{% for subitem in item.CHILDREN %}{{ subitem.text }}'
+                '{% endfor %}{% endfor %}{% endfor %}')
+        settings.LAYOUTS = patterns((r'^about$', 'tree.html'),
+                                    (r'^.*$', 'page.html'))
+        self.build()
+        self.assertEqual(self.read_page('about'), '<p>One</p>')
+
+        with open('pages/blog/a/c1/text.md', 'w') as file_:
+            file_.write('Two')
+        self.build(incremental=True)
+        self.assertEqual(self.read_page('about'), '<p>Two</p>')
+        self.assert_same_as_full_build()
+
+    def test_incremental_build_of_page_with_bundle(self):
+        previous_bundles = settings.BUNDLES
+        settings.BUNDLES = {'css': Bundle('style.css', output='bundle.css')}
+        with open('layouts/page.html', 'w') as file_:
+            file_.write('{% assets "css" %}{{ ASSET_URL }}{% endassets %}')
+        try:
+            self.build()
+            url = self.read_page('about')
+            with open('static/style.css', 'w') as file_:
+                file_.write('body { color: blue; }')
+            self.build(incremental=True)
+            self.assertNotEqual(self.read_page('about'), url)
+            self.assert_same_as_full_build()
+        finally:
+            settings.BUNDLES = previous_bundles
+
+    def test_parallel_build(self):
+        self.build()
+        serial_pages = self.read_pages()
+
+        shutil.rmtree(self.build_dir)
+        self.build(processes=3)
+        self.assertEqual(self.read_pages(), serial_pages)
+
+    def test_languages_concurrency(self):
+        started = []
+        running = []
+        max_running = [0]
+
+        class Process(object):
+            """Records the languages running at the same time."""
+            def __init__(self, target, args, kwargs):
+                self.kwargs = kwargs
+                self.exitcode = None
+
+            def start(self):
+                started.append(self.kwargs)
+                running.append(self)
+                max_running[0] = max(max_running[0], len(running))
+
+            def join(self, timeout=None):
+                if self in running:
+                    running.remove(self)
+                    self.exitcode = 0
+
+            def is_alive(self):
+                return self in running
+
+        original_process = core.multiprocessing.Process
+        core.multiprocessing.Process = Process
+        try:
+            core.build_languages(None, self.build_dir, self.build_dir,
+                                 ['en', 'ru', 'de', 'fr', 'es'], processes=2)
+        finally:
+            core.multiprocessing.Process = original_process
+
+        self.assertEqual([kwargs['language'] for kwargs in started],
+                         ['en', 'ru', 'de', 'fr', 'es'])
+        self.assertEqual(max_running[0], 2)
+        self.assertTrue(all(kwargs['processes'] == 1 for kwargs in started))
+
+    def test_parallel_languages_build(self):
+        with open('pages/about/text.ru.md', 'w') as file_:
+            file_.write('O nas')
+        previous_languages = settings.LANGUAGES
+        settings.LANGUAGES = ['en', 'ru']
+        try:
+            self.build()
+            serial_pages = self.read_pages()
+
+            shutil.rmtree(self.build_dir)
+            self.build(processes=2)
+            self.assertEqual(self.read_pages(), serial_pages)
+        finally:
+            settings.LANGUAGES = previous_languages
+
+        self.assertEqual(
+            serial_pages['ru/about/index.html'], '<p>O nas</p>')
+        self.assertEqual(
+            serial_pages['en/about/index.html'], '<p>About <em>us</em></p>')
+
+    def test_bundles_reuse(self):
+        previous_bundles = settings.BUNDLES
+        settings.BUNDLES = {'css': Bundle('style.css', output='bundle.css')}
+        try:
+            stats = self.build()
+            self.assertEqual(
+                (stats['bundles_rebuilt'], stats['bundles_reused']), (1, 0))
+
+            shutil.rmtree(self.build_dir)
+            stats = self.build()
+            self.assertEqual(
+                (stats['bundles_rebuilt'], stats['bundles_reused']), (0, 1))
+            self.assertEqual(self.read_pages()['bundle.css'],
+                             'body { color: red; }\n')
+
+            # Up to date output isn't copied again
+            bundle_path = os.path.join(self.build_dir, 'bundle.css')
+            inode = os.stat(bundle_path).st_ino
+            stats = self.build(incremental=True)
+            self.assertEqual(
+                (stats['bundles_rebuilt'], stats['bundles_reused']), (0, 1))
+            self.assertEqual(os.stat(bundle_path).st_ino, inode)
+
+            with open('static/style.css', 'w') as file_:
+                file_.write('body { color: blue; }')
+            stats = self.build(incremental=True)
+            self.assertEqual(
+                (stats['bundles_rebuilt'], stats['bundles_reused']), (1, 0))
+            self.assertEqual(self.read_pages()['bundle.css'],
+                             'body { color: blue; }')
+        finally:
+            settings.BUNDLES = previous_bundles
+
+    def test_atomic_bundles_build_without_disk_cache(self):
+        previous_bundles = settings.BUNDLES
+        previous_disk_cache = settings.DISK_CACHE
+        settings.BUNDLES = {'css': Bundle('style.css', output='bundle.css')}
+        settings.DISK_CACHE = False
+        try:
+            rebuilt = [build_atomically(
+                self.project_dir, self.build_dir,
+                manifest_dir=self.manifest_dir)['bundles_rebuilt']
+                for _ in range(3)]
+            self.assertEqual(rebuilt, [1, 0, 0])
+
+            with open('static/style.css', 'w') as file_:
+                file_.write('body { color: blue; }')
+            # webassets compares the timestamps with one second precision
+            os.utime('static/style.css', (time.time() + 2,) * 2)
+            with open(os.path.join(self.build_dir, 'bundle.css')) as file_:
+                stats = build_atomically(self.project_dir, self.build_dir,
+                                         manifest_dir=self.manifest_dir)
+                # The previous build isn't modified
+                self.assertEqual(file_.read(), 'body { color: red; }\n')
+            self.assertEqual(stats['bundles_rebuilt'], 1)
+            self.assertEqual(self.read_pages()['bundle.css'],
+                             'body { color: blue; }')
+        finally:
+            settings.BUNDLES = previous_bundles
+            settings.DISK_CACHE = previous_disk_cache
+
+    def test_static_sync(self):
+        stats = self.build()
+        self.assertEqual(stats['static']['linked'], 1)
+
+        stats = self.build(incremental=True)
+        self.assertEqual(stats['static']['unchanged'], 1)
+
+        os.remove('static/style.css')
+        with open('static/script.js', 'w') as file_:
+            file_.write('alert(1);')
+        stats = self.build(incremental=True)
+        self.assertEqual((stats['static']['linked'],
+                          stats['static']['removed']), (1, 1))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.build_dir, 'style.css')))
+        self.assertEqual(self.read_pages()['script.js'], 'alert(1);')
+
+    def test_partial_build(self):
+        self.build()
+        with open('pages/blog/a/text.md', 'w') as file_:
+            file_.write('Edited post')
+        with open('static/script.js', 'w') as file_:
+            file_.write('alert(1);')
+
+        stats = build(self.project_dir, self.build_dir,
+                      manifest_dir=self.manifest_dir, incremental=True,
+                      pages=False)
+        self.assertEqual(stats['static']['linked'], 1)
+        self.assertEqual(self.read_page('blog/a'), '<p>First post</p>')
+
+        stats = build(self.project_dir, self.build_dir,
+                      manifest_dir=self.manifest_dir, incremental=True,
+                      static=False)
+        self.assertNotIn('static', stats)
+        self.assertEqual(self.read_page('blog/a'), '<p>Edited post</p>')
+        self.assertEqual(self.read_pages()['script.js'], 'alert(1);')
+
+    def test_language_build(self):
+        previous_languages = settings.LANGUAGES
+        settings.LANGUAGES = ['en', 'ru']
+        try:
+            self.build()
+            with open('pages/about/text.md', 'w') as file_:
+                file_.write('Edited')
+            build(self.project_dir, self.build_dir,
+                  manifest_dir=self.manifest_dir, incremental=True,
+                  languages=['ru'])
+        finally:
+            settings.LANGUAGES = previous_languages
+
+        self.assertEqual(self.read_page('ru/about'), '<p>Edited</p>')
+        self.assertEqual(
+            self.read_page('en/about'), '<p>About <em>us</em></p>')
+
+    def test_atomic_build(self):
+        build_atomically(self.project_dir, self.build_dir,
+                         manifest_dir=self.manifest_dir)
+        previous_build_dir = os.path.realpath(self.build_dir)
+        previous_about = os.stat(
+            os.path.join(previous_build_dir, 'about/index.html'))
+
+        with open('pages/blog/a/text.md', 'w') as file_:
+            file_.write('Edited post')
+        build_atomically(self.project_dir, self.build_dir,
+                         manifest_dir=self.manifest_dir)
+
+        self.assertNotEqual(
+            os.path.realpath(self.build_dir), previous_build_dir)
+        self.assertEqual(self.read_page('blog/a'), '<p>Edited post</p>')
+        # Unchanged page is hardlinked to the previous build
+        self.assertEqual(
+            os.stat(os.path.join(self.build_dir, 'about/index.html')).st_ino,
+            previous_about.st_ino)
+
+        # Wait for the previous build removal
+        deadline = time.time() + 10
+        while os.path.exists(previous_build_dir) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists(previous_build_dir))
+
+    def test_atomic_build_of_deep_page(self):
+        self.write_deep_page()
+        build_atomically(self.project_dir, self.build_dir,
+                         manifest_dir=self.manifest_dir)
+        self.assertEqual(self.read_page('blog/a/deep'), 'One|,Blog,|Blog')
+
+        self.edit_root_and_blog()
+        build_atomically(self.project_dir, self.build_dir,
+                         manifest_dir=self.manifest_dir)
+        self.assertEqual(
+            self.read_page('blog/a/deep'), 'Two|,Journal,|Journal')
+
+    def test_profiling(self):
+        profile = profiling.enable()
+        try:
+            self.build(processes=2)
+        finally:
+            profiling.disable()
+
+        for stage in ('sync_static', 'create_tree', 'fill_tree', 'build_site'):
+            self.assertIn(stage, profile.stages)
+        self.assertEqual(sorted(url for _, url, _ in profile.pages),
+                         ['/about/', '/blog/', '/blog/a/', '/blog/b/'])
+        self.assertEqual(profile.get_layout_totals()[0][:2], ('page.html', 4))
+        self.assertEqual(
+            sorted((kind, os.path.relpath(path, self.project_dir))
+                   for kind, path in profile.files),
+            [('md', 'pages/about/text.md'), ('md', 'pages/blog/a/text.md'),
+             ('md', 'pages/blog/b/text.md'), ('yaml', 'pages/blog/data.yaml')])
+        self.assertIn('Slowest pages:', profile.get_report())
+
+    def test_cancelled_build(self):
+        build_atomically(self.project_dir, self.build_dir,
+                         manifest_dir=self.manifest_dir)
+        previous_build_dir = os.path.realpath(self.build_dir)
+
+        with open('pages/blog/a/text.md', 'w') as file_:
+            file_.write('Edited post')
+        cancel_event = threading.Event()
+        cancel_event.set()
+        self.assertRaises(
+            BuildCancelledException, build_atomically,
+            self.project_dir, self.build_dir, manifest_dir=self.manifest_dir,
+            cancel_event=cancel_event)
+
+        self.assertEqual(os.path.realpath(self.build_dir), previous_build_dir)
+        self.assertEqual(self.read_page('blog/a'), '<p>First post</p>')
+        # Neither the new build nor it's manifests are left behind
+        self.assertEqual(
+            [name for name in os.listdir(self.project_dir)
+             if '.build-' in name],
+            [os.path.basename(previous_build_dir)])
+
+    def test_site_reuse(self):
+        site = Site(self.project_dir)
+        build(self.project_dir, self.build_dir,
+              manifest_dir=self.manifest_dir, site=site)
+        tree = site.get_tree()
+        jinja2_env = site.get_jinja2_env(None, self.build_dir)
+
+        build(self.project_dir, self.build_dir,
+              manifest_dir=self.manifest_dir, incremental=True, site=site)
+        self.assertIs(site.get_tree(), tree)
+        self.assertIs(site.get_jinja2_env(None, self.build_dir), jinja2_env)
+
+        with open('pages/blog/a/text.md', 'w') as file_:
+            file_.write('Edited post')
+        build(self.project_dir, self.build_dir,
+              manifest_dir=self.manifest_dir, incremental=True, site=site)
+        self.assertIsNot(site.get_tree(), tree)
+        self.assertIs(site.get_jinja2_env(None, self.build_dir), jinja2_env)
+        self.assertEqual(self.read_page('blog/a'), '<p>Edited post</p>')
+        self.assertEqual(
+            self.read_page('blog'),
+            'Blog<a href="/blog/a/">a</a><a href="/blog/b/">b</a>')
+
+    def test_rendering_on_demand(self):
+        site = Site(self.project_dir)
+        site.refresh()
+        self.assertEqual(
+            sorted(site.get_page_index()),
+            ['about/', 'blog/', 'blog/a/', 'blog/b/'])
+        self.assertIsNone(site.render_url('missing/', self.build_dir))
+
+        blog = site.render_url('blog/', self.build_dir)
+        about = site.render_url('about/', self.build_dir)
+        self.assertEqual(
+            blog, 'Blog<a href="/blog/a/">a</a><a href="/blog/b/">b</a>')
+        self.assertEqual(about, '<p>About <em>us</em></p>')
+        self.assertFalse(os.path.exists(self.build_dir))
+
+        with open('pages/blog/a/text.md', 'w') as file_:
+            file_.write('Edited post')
+        site.refresh()
+        self.assertEqual(
+            site.render_url('blog/a/', self.build_dir), '<p>Edited post</p>')
+        # Pages which inputs haven't changed are memoized
+        self.assertIs(site.render_url('about/', self.build_dir), about)
+
+    def test_rendering_deep_page_on_demand(self):
+        self.write_deep_page()
+        site = Site(self.project_dir)
+        site.refresh()
+        self.assertEqual(site.render_url('blog/a/deep/', self.build_dir),
+                         'One|,Blog,|Blog')
+
+        self.edit_root_and_blog()
+        site.refresh()
+        self.assertEqual(site.render_url('blog/a/deep/', self.build_dir),
+                         'Two|,Journal,|Journal')
@@ -0,0 +1,106 @@
+import os
+import time
+import shutil
+import datetime
+import tempfile
+import unittest
+
+import yaml
+
+from carcade import cache
+from carcade.cache import LRUCache, DiskCache
+from carcade.environments import render_markdown
+from carcade.utils import load_yaml
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)  # Evicts 'b' as the least recently used
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test(self):
+        DiskCache(self.cache_dir).set('abcdef', {'a': [1, 2]})
+        disk_cache = DiskCache(self.cache_dir)
+        self.assertEqual(disk_cache.get('abcdef'), {'a': [1, 2]})
+        self.assertEqual(disk_cache.get('123456', 'default'), 'default')
+
+    def test_prune(self):
+        cache.configure(self.cache_dir)
+        try:
+            disk_cache = DiskCache(os.path.join(self.cache_dir, 'yaml'))
+            for key in ('aaaaaa', 'bbbbbb', 'cccccc'):
+                disk_cache.set(key, key)
+            month_ago = time.time() - 31 * 24 * 60 * 60
+            for key in ('aaaaaa', 'bbbbbb'):
+                os.utime(disk_cache._get_path(key), (month_ago, month_ago))
+            # Reading marks the entry as used
+            self.assertEqual(disk_cache.get('bbbbbb'), 'bbbbbb')
+
+            self.assertEqual(cache.prune(30 * 24 * 60 * 60), 1)
+            self.assertIsNone(disk_cache.get('aaaaaa'))
+            self.assertEqual(disk_cache.get('bbbbbb'), 'bbbbbb')
+            self.assertEqual(disk_cache.get('cccccc'), 'cccccc')
+        finally:
+            cache.configure(None)
+
+
+class MarkdownCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        cache.configure(self.cache_dir)
+
+    def tearDown(self):
+        cache.configure(None)
+        shutil.rmtree(self.cache_dir)
+
+    def test(self):
+        self.assertEqual(render_markdown(u'*Hi*'), u'<p><em>Hi</em></p>')
+
+        # Second call is served from the cache: memory tier first,
+        # then the disk tier
+        markdown_cache = cache.get_cache('markdown')
+        markdown_cache.memory.clear()
+        self.assertEqual(render_markdown(u'*Hi*'), u'<p><em>Hi</em></p>')
+        self.assertEqual(len(markdown_cache.memory._items), 1)
+
+
+class YAMLCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        cache.configure(self.cache_dir)
+
+    def tearDown(self):
+        cache.configure(None)
+        shutil.rmtree(self.cache_dir)
+
+    def test(self):
+        text = u'date: 2013-05-01\nspeakers: [a, b]\n'
+        expected = {'date': datetime.date(2013, 5, 1), 'speakers': ['a', 'b']}
+        self.assertEqual(load_yaml(text), expected)
+
+        yaml_cache = cache.get_cache('yaml')
+        yaml_cache.memory.clear()
+        original_load = yaml.load
+        yaml.load = None
+        try:
+            self.assertEqual(load_yaml(text), expected)  # From the disk
+        finally:
+            yaml.load = original_load
+
+        # Only the safe subset of YAML is supported
+        self.assertRaises(yaml.YAMLError, load_yaml,
+                          u'!!python/object/apply:os.getcwd []')
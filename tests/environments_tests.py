@@ -7,6 +7,7 @@ import unittest
 from jinja2 import TemplateSyntaxError
 from webassets import Bundle
 
+from carcade import cache
 from carcade.core import get_translations
 from carcade.environments import create_assets_env, create_jinja2_env
 
@@ -61,3 +62,14 @@ class Jinja2EnvironmentTest(unittest.TestCase):
         jinja2_env = create_jinja2_env(translations=translations)
         result = jinja2_env.from_string(template).render()
         self.assertEqual(u'Привет!', result)
+
+    def test_bytecode_cache(self):
+        cache.configure(self.build_dir)
+        try:
+            jinja2_env = create_jinja2_env(layouts_dir='tests/fixtures/layouts')
+            jinja2_env.get_template('test.html')
+        finally:
+            cache.configure(None)
+
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.build_dir, 'templates'))), 1)
@@ -1,10 +1,14 @@
+# coding: utf-8
+import os
+import shutil
 import unittest
 import tempfile
 
 import polib
 
+from carcade import i18n
 from carcade.environments import create_jinja2_env
-from carcade.i18n import extract_translations
+from carcade.i18n import extract_translations, get_translations
 
 
 class TranslationsExtractionTest(unittest.TestCase):
@@ -26,3 +30,73 @@ class TranslationsExtractionTest(unittest.TestCase):
                 '#: test.html:1 test.html:3\n'
                 'msgid "sites"\n'
                 'msgstr "sites"\n')
+
+    def test_incremental(self):
+        project_dir = tempfile.mkdtemp()
+        layouts_dir = os.path.join(project_dir, 'layouts')
+        os.mkdir(layouts_dir)
+        try:
+            for name in ('a.html', 'b.html', 'c.html'):
+                shutil.copy('tests/fixtures/layouts/test.html',
+                            os.path.join(layouts_dir, name))
+            jinja2_env = create_jinja2_env(layouts_dir=layouts_dir)
+            pot_file_path = os.path.join(project_dir, 'messages.pot')
+
+            self.assertTrue(extract_translations(
+                jinja2_env, pot_file_path, processes=2))
+            with open(pot_file_path) as pot_file:
+                content = pot_file.read()
+            self.assertEqual(
+                str(polib.pofile(pot_file_path)[1]),
+                '#: a.html:1 a.html:3 b.html:1 b.html:3 c.html:1 c.html:3\n'
+                'msgid "sites"\n'
+                'msgstr "sites"\n')
+
+            # Unchanged templates are taken from the cache
+            original_parse_messages = i18n.parse_messages
+            i18n.parse_messages = None
+            try:
+                self.assertFalse(
+                    extract_translations(jinja2_env, pot_file_path))
+            finally:
+                i18n.parse_messages = original_parse_messages
+            with open(pot_file_path) as pot_file:
+                self.assertEqual(pot_file.read(), content)
+
+            with open(os.path.join(layouts_dir, 'b.html'), 'w') as template:
+                template.write("{{ _('Dynamic') }}")
+            self.assertTrue(extract_translations(jinja2_env, pot_file_path))
+            self.assertEqual(
+                [entry.msgid for entry in polib.pofile(pot_file_path)],
+                ['Dynamic', 'Static', 'sites'])
+        finally:
+            shutil.rmtree(project_dir)
+
+
+class TranslationsLoadingTest(unittest.TestCase):
+    def setUp(self):
+        self.po_dir = tempfile.mkdtemp()
+        self.po_file_path = os.path.join(self.po_dir, 'ru.po')
+        shutil.copy('tests/fixtures/ru.po', self.po_file_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.po_dir)
+
+    def test(self):
+        translations = get_translations(self.po_file_path)
+        self.assertEqual(translations.ugettext('Hey!'), u'Привет!')
+
+        # Compiled catalog is taken from the cache while the PO file is the same
+        original_pofile = polib.pofile
+        polib.pofile = None
+        try:
+            translations = get_translations(self.po_file_path)
+        finally:
+            polib.pofile = original_pofile
+        self.assertEqual(translations.ugettext('Hey!'), u'Привет!')
+
+        po_file = polib.pofile(self.po_file_path)
+        po_file.find('Hey!').msgstr = u'Hi!'
+        po_file.save()
+        translations = get_translations(self.po_file_path)
+        self.assertEqual(translations.ugettext('Hey!'), u'Hi!')
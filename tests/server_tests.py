@@ -0,0 +1,194 @@
+import os
+import time
+import zlib
+import shutil
+import httplib
+import tempfile
+import threading
+import unittest
+
+from webassets import Bundle
+
+from carcade import cache
+from carcade.conf import settings
+from carcade.core import Site
+from carcade.utils import patterns
+from carcade.server import (
+    Changes, HTTPServer, RequestHandler, affects_bundles, build_lazily,
+    refresh_site)
+
+
+class ChangesTest(unittest.TestCase):
+    def test_timeout(self):
+        changes = Changes()
+        self.assertEqual(changes.wait(0.01, timeout=0.01), set())
+
+    def test_coalescing(self):
+        changes = Changes()
+
+        def change_files():
+            for i in range(5):
+                changes.add('/site/pages/%i/text.md' % i)
+                time.sleep(0.01)
+        thread = threading.Thread(target=change_files)
+        thread.start()
+
+        paths = changes.wait(0.1, timeout=1)
+        thread.join()
+        self.assertEqual(len(paths), 5)
+        self.assertEqual(changes.wait(0.01, timeout=0.01), set())
+
+
+class AffectsBundlesTest(unittest.TestCase):
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.project_dir, 'static/css'))
+        for name in ('one.css', 'two.css', 'other.css'):
+            with open(os.path.join(self.project_dir, 'static/css', name),
+                      'w') as file_:
+                file_.write('body {}')
+        self.previous_bundles = settings.BUNDLES
+        settings.BUNDLES = {'css': Bundle(
+            'css/one.css', Bundle('css/two.css'), output='gen/all.css')}
+
+    def tearDown(self):
+        settings.BUNDLES = self.previous_bundles
+        shutil.rmtree(self.project_dir)
+
+    def test(self):
+        self.assertTrue(affects_bundles(
+            self.project_dir, ['static/css/one.css']))
+        self.assertTrue(affects_bundles(
+            self.project_dir, ['static/css/other.css', 'static/css/two.css']))
+        self.assertFalse(affects_bundles(
+            self.project_dir, ['static/css/other.css']))
+
+        os.remove(os.path.join(self.project_dir, 'static/css/one.css'))
+        self.assertTrue(affects_bundles(
+            self.project_dir, ['static/css/one.css']))
+
+
+class QuietRequestHandler(RequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class RequestHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.www_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.www_dir, 'style.css'), 'w') as file_:
+            file_.write('body { color: red; }')
+        with open(os.path.join(self.www_dir, 'style.css.gz'), 'wb') as file_:
+            file_.write(zlib.compress('body { color: red; }'))
+        os.mkdir(os.path.join(self.www_dir, 'about'))
+        with open(os.path.join(self.www_dir, 'about/index.html'), 'w') as file_:
+            file_.write('About us')
+
+        self.http_server = HTTPServer(('localhost', 0), QuietRequestHandler)
+        self.http_server.www_dir = self.www_dir
+        thread = threading.Thread(target=self.http_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.connection = httplib.HTTPConnection(
+            'localhost', self.http_server.server_address[1])
+
+    def tearDown(self):
+        self.connection.close()
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        shutil.rmtree(self.www_dir)
+
+    def get(self, path, **headers):
+        self.connection.request('GET', path, headers=headers)
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test_keep_alive(self):
+        # All the requests are made over the same connection
+        response, body = self.get('/about/')
+        self.assertEqual((response.status, body), (200, 'About us'))
+        response, body = self.get('/about')
+        self.assertEqual(response.status, 301)
+        self.assertEqual(response.getheader('Location'), '/about/')
+        response, body = self.get('/missing')
+        self.assertEqual(response.status, 404)
+
+    def test_conditional_get(self):
+        response, body = self.get('/style.css')
+        self.assertEqual(body, 'body { color: red; }')
+        etag = response.getheader('ETag')
+        last_modified = response.getheader('Last-Modified')
+
+        response, body = self.get('/style.css', **{'If-None-Match': etag})
+        self.assertEqual((response.status, body), (304, ''))
+        response, body = self.get(
+            '/style.css', **{'If-Modified-Since': last_modified})
+        self.assertEqual((response.status, body), (304, ''))
+        response, body = self.get('/style.css', **{'If-None-Match': '"x"'})
+        self.assertEqual(response.status, 200)
+
+    def test_precompressed_file(self):
+        response, body = self.get(
+            '/style.css', **{'Accept-Encoding': 'br;q=0.9, gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(response.getheader('Content-Type'), 'text/css')
+        self.assertEqual(zlib.decompress(body), 'body { color: red; }')
+
+        response, body = self.get('/style.css')
+        self.assertIsNone(response.getheader('Content-Encoding'))
+        self.assertEqual(body, 'body { color: red; }')
+
+
+class LazyServingTest(unittest.TestCase):
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.project_dir = os.path.join(tempfile.mkdtemp(), 'project')
+        shutil.copytree('./tests/fixtures/project', self.project_dir)
+        os.chdir(self.project_dir)
+        self.previous_layouts = settings.LAYOUTS
+        settings.LAYOUTS = patterns((r'^.*$', 'page.html'))
+
+        self.http_server = HTTPServer(('localhost', 0), QuietRequestHandler)
+        self.http_server.lock = threading.Lock()
+        self.site = Site(self.project_dir)
+        build_lazily(self.http_server, self.project_dir, self.site)
+        thread = threading.Thread(target=self.http_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.connection = httplib.HTTPConnection(
+            'localhost', self.http_server.server_address[1])
+
+    def tearDown(self):
+        self.connection.close()
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        settings.LAYOUTS = self.previous_layouts
+        cache.configure(None)
+        os.chdir(self.previous_dir)
+        shutil.rmtree(os.path.dirname(self.project_dir))
+
+    def get(self, path):
+        self.connection.request('GET', path)
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test(self):
+        refreshes = []
+        refresh = self.site.refresh
+        self.site.refresh = lambda: refreshes.append(1) or refresh()
+
+        response, body = self.get('/about/')
+        self.assertEqual(body, '<p>About <em>us</em></p>')
+        response, body = self.get('/blog')
+        self.assertEqual(response.getheader('Location'), '/blog/')
+        response, body = self.get('/style.css')
+        self.assertEqual((response.status, body),
+                         (200, 'body { color: red; }\n'))
+        # Requests don't rescan the sources
+        self.assertEqual(refreshes, [])
+
+        with open('pages/about/text.md', 'w') as file_:
+            file_.write('Edited')
+        refresh_site(self.http_server, self.site)
+        response, body = self.get('/about/')
+        self.assertEqual(body, '<p>Edited</p>')
@@ -1,6 +1,14 @@
+import os
+import shutil
+import tempfile
 import unittest
 
-from carcade.core import create_tree, paginate_tree, sort_tree
+from carcade.core import (
+    create_tree, paginate_tree, sort_tree, index_tree, iter_tree, url_for,
+    freeze_tree, fill_tree, Node)
+from carcade.exceptions import FrozenTreeException
+from carcade.inventory import create_inventory
+from carcade.utils import order_by, read_base_contexts, Lazy
 
 
 class Test(unittest.TestCase):
@@ -27,6 +35,25 @@ class Test(unittest.TestCase):
         }
         self.assert_tree_structure(tree, expected_tree_structure)
 
+    def test_creation_from_inventory(self):
+        inventory = create_inventory('./tests/fixtures/fixture', threads=2)
+        self.assertEqual(inventory['./tests/fixtures/fixture/a'].subdirs,
+                         ['1', '2'])
+
+        tree = create_tree(
+            './tests/fixtures/fixture', 'ROOT', inventory=inventory)
+        expected_tree_structure = {
+            'a': {
+                '1': {
+                    'hello': {},
+                },
+                '2': {},
+            },
+            'b': {},
+            'c': {},
+        }
+        self.assert_tree_structure(tree, expected_tree_structure)
+
     def test_pagination(self):
         tree = create_tree('./tests/fixtures/fixture2/', 'ROOT')
         expected_tree_structure = {
@@ -64,3 +91,86 @@ class Test(unittest.TestCase):
             },
         }
         self.assert_tree_structure(tree, expected_tree_structure)
+
+    def test_ordering_by_context(self):
+        pages_dir = tempfile.mkdtemp()
+        try:
+            for name, data in [('a', 'date: 2013-05-01'), ('b', ''),
+                               ('c', 'date: 2013-06-01'),
+                               ('d', 'date: 2013-04-01')]:
+                os.makedirs(os.path.join(pages_dir, 'news', name))
+                with open(os.path.join(
+                        pages_dir, 'news', name, 'data.yaml'), 'w') as file_:
+                    file_.write(data)
+            inventory = create_inventory(pages_dir)
+            base_contexts = read_base_contexts(inventory)
+
+            tree = create_tree(pages_dir, 'ROOT', inventory=inventory)
+            tree = sort_tree(tree, {'news': order_by('date', reverse=True)},
+                             base_contexts=base_contexts)
+            self.assertEqual(
+                [child.name for child in tree.get_child('news').children],
+                ['c', 'a', 'd', 'b'])
+
+            # Without base contexts the files are parsed
+            tree = create_tree(pages_dir, 'ROOT')
+            tree = sort_tree(tree, {'news': order_by('date')})
+            self.assertEqual(
+                [child.name for child in tree.get_child('news').children],
+                ['d', 'a', 'c', 'b'])
+        finally:
+            shutil.rmtree(pages_dir)
+
+    def test_lazy_contexts(self):
+        tree = create_tree('./tests/fixtures/project/pages', 'ROOT')
+        tree = fill_tree(tree)
+        blog = tree.get_child('blog')
+        a_context = blog.get_child('a').context
+
+        # Markdown isn't parsed until the value is read
+        text = dict.__getitem__(a_context, 'text')
+        self.assertIsInstance(text, Lazy)
+        self.assertIsNotNone(text.loader)
+        self.assertEqual(a_context['text'], u'<p>First post</p>')
+        self.assertIsNone(text.loader)
+        self.assertEqual(a_context.get('text'), text.get())
+        self.assertEqual(blog.context['title'], 'Blog')
+
+    def test_index(self):
+        tree = create_tree('./tests/fixtures/fixture2/', 'ROOT')
+        tree = sort_tree(tree, {'blog': 'alphabetically'})
+        tree = paginate_tree(tree, {'blog': 2})
+
+        paths = ['blog', 'blog/page2', 'blog/c', 'blog/page2/c', 'blog/x']
+        expected_nodes = [tree.find_descendant(path) for path in paths]
+        expected_urls = [url_for(tree, path) for path in paths[:-1]]
+
+        tree = index_tree(tree)
+        self.assertEqual(len(tree.path_index), len(list(iter_tree(tree))) + 6)
+        self.assertEqual(
+            [tree.find_descendant(path) for path in paths], expected_nodes)
+        self.assertEqual(
+            [url_for(tree, path) for path in paths[:-1]], expected_urls)
+        self.assertEqual(url_for(tree, 'blog/c'), '/blog/c/')
+        self.assertEqual(url_for(tree, 'blog/page2'), '/blog/page2/')
+
+    def test_freezing(self):
+        tree = create_tree('./tests/fixtures/fixture2/', 'ROOT')
+        tree = sort_tree(tree, {'blog': 'alphabetically'})
+        tree = paginate_tree(tree, {'blog': 2})
+
+        nodes = list(iter_tree(tree))
+        expected = [(node.get_path(), node.get_depth(), node.get_slugs())
+                    for node in nodes]
+
+        tree = freeze_tree(tree)
+        self.assertTrue(all(node.frozen for node in nodes))
+        self.assertEqual(
+            [(node.get_path(), node.get_depth(), node.get_slugs())
+             for node in nodes],
+            expected)
+        self.assertEqual(
+            tree.find_descendant('blog/page2/c').get_slugs(),
+            ('blog', '', 'c'))
+        self.assertRaises(
+            FrozenTreeException, tree.add_child, Node('.', 'new'))
@@ -0,0 +1,35 @@
+import re
+import unittest
+
+from carcade.utils import patterns
+
+
+class RegexResolverTest(unittest.TestCase):
+    def assert_first_match(self, items, keys):
+        resolver = patterns(*items)
+        for key in keys:
+            expected = next((value for pattern, value in items
+                             if re.match(pattern, key)), None)
+            self.assertEqual(resolver.get(key), expected)
+            self.assertEqual(resolver.get(key), expected)  # Memoized
+
+    def test(self):
+        self.assert_first_match([
+            (r'^content$', 'content'),
+            (r'^content/(a|b)/.*$', 'ab'),
+            (r'^(x)\1$', 'backreference'),
+            (r'(?i)^up$', 'flags'),
+            (r'^(?P<name>q)$', 'q'),
+            (r'^(?P<name>q.)$', 'qq'),
+            (r'^content/.*$', 'speech'),
+            (r'^[^/]*$', 'page'),
+        ], ['content', 'content/a/1', 'content/c', 'xx', 'UP', 'q', 'qq',
+            'page', 'a/b', ''])
+
+        resolver = patterns((r'^a$', 1))
+        self.assertRaises(KeyError, lambda: resolver['b'])
+
+    def test_many_groups(self):
+        items = [(r'^(a)(b)(c)%i$' % i, i) for i in range(80)]
+        self.assert_first_match(items + [(r'^.*$', 'default')],
+                                ['abc%i' % i for i in range(81)])